@@ -0,0 +1,293 @@
+""" Author: Dominik Beese
+>>> Game Patcher Benchmark
+	Times the steps of Game Patcher with synthetic games and stub tools.
+	The stub tools only read and write their files, so the timings show the overhead of Game Patcher itself.
+<<<
+"""
+
+import argparse
+import sys
+import json
+import struct
+import hashlib
+import platform
+import zlib
+from os import chdir, chmod, urandom, remove, getcwd
+from os.path import join, isdir, isfile, abspath, split
+from shutil import rmtree
+from subprocess import call, DEVNULL
+from stat import S_IRWXU
+from io import StringIO
+from zipfile import ZipFile
+from tempfile import mkdtemp
+from contextlib import redirect_stdout
+from statistics import median
+from time import perf_counter
+from datetime import datetime
+
+from GamePatcher import VERSION, extractGame, prepareGame, applyPatches, rebuildGame, escapeName, createName
+
+MiB = 1024*1024
+
+
+###########
+## Tools ##
+###########
+
+# stub tools with the command line interface of the real tools
+# partitions are stored as 'STUB', the length of a json header with the size of each section and the sections
+STUB = r'''
+import sys, json, struct
+from os.path import basename
+from shutil import copyfileobj
+
+def options(args):
+	return {args[i]: args[i+1] for i in range(len(args)-1) if args[i].startswith('-') and not args[i+1].startswith('-')}
+
+def pack(output, sections):
+	sizes = dict()
+	for name, filename in sections.items():
+		with open(filename, 'rb') as file: sizes[name] = file.seek(0, 2)
+	header = json.dumps(sizes).encode()
+	with open(output, 'wb') as out:
+		out.write(b'STUB' + struct.pack('<I', len(header)) + header)
+		for name, filename in sections.items():
+			with open(filename, 'rb') as file: copyfileobj(file, out, 2**20)
+
+def unpack(input, sections):
+	with open(input, 'rb') as file:
+		if file.read(4) != b'STUB': sys.exit('Invalid file: %s' % input)
+		sizes = json.loads(file.read(struct.unpack('<I', file.read(4))[0]))
+		for name, size in sizes.items():
+			if name not in sections:
+				file.seek(size, 1)
+				continue
+			with open(sections[name], 'wb') as out:
+				while size:
+					data = file.read(min(size, 2**20))
+					out.write(data)
+					size -= len(data)
+
+tool, args = basename(sys.argv[0]), sys.argv[1:]
+if tool == '3dstool':
+	opts = options(args[3:])
+	if args[0] == '-xtf': unpack(args[2], opts)
+	else: pack(args[2], opts)
+elif tool == 'makerom':
+	contents = {'-content%d' % i: arg.rsplit(':', 2)[0] for i, arg in enumerate(args[j+1] for j in range(len(args)) if args[j] == '-content')}
+	pack(options(args)['-o'], contents)
+elif tool == 'xdelta':
+	sys.stdin.buffer.read()
+	with open(args[args.index('-s')+1], 'rb') as file: copyfileobj(file, sys.stdout.buffer, 2**20)
+else: sys.exit('%s is not supported' % tool)
+'''
+
+def createTools(tool_dir):
+	""" Writes the stub tools to [tool_dir] and returns a dict mapping each tool name to its path. """
+	tools = dict()
+	for tool in ['xdelta', '3dstool', 'ctrtool', 'makerom']:
+		tools[tool] = join(tool_dir, tool)
+		with open(tools[tool], 'w') as file: file.write('#!%s\n%s' % (sys.executable, STUB))
+		chmod(tools[tool], S_IRWXU)
+	return tools
+
+
+##############
+## Fixtures ##
+##############
+
+def writeData(file, size, chunk = urandom(16*MiB)):
+	""" Writes [size] bytes of random data to [file]. """
+	while size:
+		size -= file.write(chunk[:min(size, len(chunk))])
+
+def exefs(files):
+	""" Returns an ExeFS containing the [files] given as a list of (name, data). """
+	header = bytearray(0x200)
+	body = b''
+	for i, (name, data) in enumerate(files):
+		header[i*0x10:i*0x10+16] = name.encode().ljust(8, b'\0') + struct.pack('<II', len(body), len(data))
+		header[0x1E0-i*0x20:0x200-i*0x20] = hashlib.sha256(data).digest()
+		body += data + bytes(-len(data) % 0x200)
+	return bytes(header) + body
+
+def stubSize(sections):
+	""" Returns the size of a stub partition with the [sections] given as a dict mapping a name to its size. """
+	return 8 + len(json.dumps(sections).encode()) + sum(sections.values())
+
+def writeStub(file, sections, data):
+	""" Writes a stub partition with the [sections] to [file]. [data] maps a name to the data of its section
+		or None to write random data.
+	"""
+	header = json.dumps(sections).encode()
+	file.write(b'STUB' + struct.pack('<I', len(header)) + header)
+	for name, size in sections.items():
+		if data.get(name) is None: writeData(file, size)
+		else: file.write(data[name])
+
+def createGame(game_file, romfs_size):
+	""" Writes a decrypted CIA file to [game_file] with a RomFS of [romfs_size] bytes and a manual. """
+	code = urandom(2*MiB)
+	data = [
+		{'--header': bytes(0x200), '--exh': bytes(0x800), '--exefs': exefs([('.code', code), ('banner', urandom(0x3000)), ('icon', urandom(0x36C0))]), '--romfs': None, '--logo': bytes(0x2000), '--plain': bytes(0x100)},
+		{'--header': bytes(0x200), '--romfs': None}
+	]
+	sections = [{name: len(value) if value is not None else romfs_size for name, value in data[0].items()}, {'--header': 0x200, '--romfs': MiB}]
+	sizes = [stubSize(s) for s in sections]
+	# header, certificates, ticket and tmd with one content chunk record for each partition
+	align = lambda data: data + bytes(-len(data) % 64)
+	tmd = bytearray(struct.pack('>I', 0x10004) + bytes(0x13C + 0xC4 + 0x900))
+	tmd[0x140+0x9E:0x140+0xA0] = struct.pack('>H', len(sizes))
+	for index, size in enumerate(sizes): tmd += struct.pack('>IHHQ', index, index, 0, size) + bytes(0x20)
+	header = bytearray(0x2020)
+	struct.pack_into('<IHHIIIIQ', header, 0, 0x2020, 0, 0, 0xA00, 0x350, len(tmd), 0, sum(sizes))
+	header[0x20] = 0xC0
+	with open(game_file, 'wb') as file:
+		for part in [header, bytes(0xA00), bytes(0x350), tmd]: file.write(align(bytes(part)))
+		for s, d in zip(sections, data): writeStub(file, s, d)
+	return code
+
+def vcdiff(windows):
+	""" Returns a VCDIFF delta with the [windows] given as a list of (source_offset, source_size, adds, target).
+		Each window adds the bytes [adds] and copies the rest of the source segment behind them.
+	"""
+	def integer(value):
+		data = [value & 0x7F]
+		while value > 0x7F:
+			value >>= 7
+			data.append(0x80 | (value & 0x7F))
+		return bytes(reversed(data))
+	delta = bytearray(b'\xd6\xc3\xc4\x00\x00')
+	for offset, size, adds, target in windows:
+		copy = size - len(adds)
+		insts = bytes([1]) + integer(len(adds)) + (bytes([19]) + integer(copy) if copy else b'') # ADD, COPY with mode 0
+		addrs = integer(len(adds)) if copy else b''
+		encoding = integer(size) + b'\0' + integer(len(adds)) + integer(len(insts)) + integer(len(addrs)) + struct.pack('>I', zlib.adler32(target)) + adds + insts + addrs
+		delta += bytes([0x01 | 0x04]) + integer(size) + integer(offset) + integer(len(encoding)) + encoding
+	return bytes(delta)
+
+def createPatch(patch_file, game_dir, code, window_size = 8*MiB):
+	""" Writes a patch file to [patch_file] that changes the first bytes of every window of the RomFS,
+		of the manual and of the [code] of the game extracted to [game_dir].
+	"""
+	def windows(filename):
+		with open(filename, 'rb') as file:
+			offset = 0
+			while True:
+				source = file.read(window_size)
+				if not source: break
+				adds = urandom(min(16, len(source)))
+				yield offset, len(source), adds, adds + source[len(adds):]
+				offset += len(source)
+	with ZipFile(patch_file, 'w') as file:
+		file.writestr('RomFS.xdelta', vcdiff(windows(join(game_dir, 'DecryptedRomFS.bin'))))
+		file.writestr('Manual.xdelta', vcdiff(windows(join(game_dir, 'DecryptedManual.bin'))))
+		file.writestr('code.xdelta', vcdiff([(0, len(code), b'CODE', b'CODE' + code[4:])]))
+
+
+###############
+## Benchmark ##
+###############
+
+PATCHES = {
+	'RomFS.xdelta':  ('DecryptedRomFS.bin', 'CustomRomFS.bin'),
+	'Manual.xdelta': ('DecryptedManual.bin', 'CustomManual.bin'),
+	'code.xdelta':   (join('ExtractedExeFS', 'code.bin'), join('CustomExeFS', 'code.bin'))
+}
+
+def timeStep(func, verbose = False):
+	""" Calls [func] and returns the wall time in seconds. Raises an exception containing the output if it fails. """
+	output = StringIO()
+	with redirect_stdout(sys.stdout if verbose else output):
+		start = perf_counter()
+		success = func()
+		duration = perf_counter() - start
+	if not success: raise Exception(output.getvalue().strip() or 'Failed')
+	return duration
+
+def main():
+	parser = argparse.ArgumentParser(description='Times the steps of Game Patcher with synthetic games and stub tools.')
+	parser.add_argument('--romfs-size', metavar='MiB', dest='romfs_size', nargs=1, type=int, default=[100], \
+		help='The size of the RomFS of the synthetic game in MiB.')
+	parser.add_argument('--runs', metavar='N', dest='runs', nargs=1, type=int, default=[3], \
+		help='How often each step is timed.')
+	parser.add_argument('--workspace', metavar='mode', dest='workspace', nargs=1, choices=['link', 'copy'], default=['link'], \
+		help='The workspace mode used to prepare the patch game folder.')
+	parser.add_argument('--decoder', metavar='decoder', dest='decoder', nargs=1, choices=['native', 'xdelta'], default=['native'], \
+		help='Whether the patches are applied with the built-in decoder or with the xdelta stub.')
+	parser.add_argument('--jobs', metavar='N', dest='jobs', nargs=1, type=int, default=[1], \
+		help='The number of patches that are applied at the same time.')
+	parser.add_argument('--dir', metavar='dir', dest='dir', nargs=1, default=[None], \
+		help='The directory for the fixtures. Defaults to a new temporary directory that is deleted afterwards.')
+	parser.add_argument('--output', metavar='file', dest='output', nargs=1, default=['Benchmark.json'], \
+		help='The json file the results are written to.')
+	parser.add_argument('--verbose', dest='verbose', action='store_const', const=True, default=False, \
+		help='Print the output of Game Patcher.')
+	args = parser.parse_args()
+	output_file = abspath(args.output[0])
+	repository = split(abspath(__file__))[0]
+
+	# fixtures
+	dir = abspath(args.dir[0] or mkdtemp(prefix='GamePatcherBenchmark'))
+	cwd = getcwd()
+	chdir(dir)
+	try:
+		print('Create fixtures in', dir)
+		tools = createTools(dir)
+		game_file, patch_file = 'Game.cia', 'Patch.zip'
+		code = createGame(game_file, args.romfs_size[0] * MiB)
+		game_dir, patch_dir = escapeName(game_file), escapeName(createName(game_file, patch_file))
+		if isdir(game_dir): rmtree(game_dir)
+		timeStep(lambda: extractGame(game_file, dstool=tools['3dstool'], ctrtool=tools['ctrtool']), args.verbose)
+		createPatch(patch_file, game_dir, code)
+		print()
+
+		# steps, each run starts from the state the previous step left behind
+		# import and startup are timed in a new interpreter since the module is already loaded here
+		def load():
+			return call([sys.executable, '-c', 'import GamePatcher'], cwd=repository) == 0
+		def startup():
+			return call([sys.executable, join(repository, 'GamePatcher.py'), '--help'], stdout=DEVNULL) == 0
+		def extract():
+			rmtree(game_dir, ignore_errors=True)
+			return extractGame(game_file, dstool=tools['3dstool'], ctrtool=tools['ctrtool'])
+		def prepare():
+			rmtree(patch_dir, ignore_errors=True)
+			return prepareGame(patch_file, game_file, workspace=args.workspace[0])
+		def apply():
+			native_limit = float('inf') if args.decoder[0] == 'native' else 0
+			return applyPatches(patch_file, game_file, PATCHES, tools['xdelta'], jobs=args.jobs[0], native_limit=native_limit)
+		def rebuild():
+			for file in [join(patch_dir, 'Rebuild.json'), createName(game_file, patch_file)]:
+				if isfile(file): remove(file)
+			return rebuildGame(patch_file, game_file, 1024, dstool=tools['3dstool'], makerom=tools['makerom'])
+		steps = {'import': load, 'startup': startup, 'extract': extract, 'prepare': prepare, 'apply': apply, 'rebuild': rebuild}
+		timings = {step: list() for step in steps}
+		for run in range(args.runs[0]):
+			print('Run %d/%d' % (run + 1, args.runs[0]))
+			for step, func in steps.items():
+				timings[step].append(timeStep(func, args.verbose))
+				print(' ', step.ljust(7), '%.3fs' % timings[step][-1])
+		print()
+
+	finally:
+		chdir(cwd)
+		if args.dir[0] is None: rmtree(dir, ignore_errors=True)
+
+	# results
+	results = {
+		'version': VERSION,
+		'date': datetime.now().isoformat(timespec='seconds'),
+		'platform': platform.platform(),
+		'python': platform.python_version(),
+		'config': {'romfs_size': args.romfs_size[0] * MiB, 'runs': args.runs[0], 'workspace': args.workspace[0], 'decoder': args.decoder[0], 'jobs': args.jobs[0]},
+		'steps': {step: {'min': min(times), 'median': median(times), 'runs': times} for step, times in timings.items()}
+	}
+	with open(output_file, 'w') as file: json.dump(results, file, indent=2)
+	print(' ', 'Step'.ljust(7), 'Min'.rjust(9), 'Median'.rjust(9))
+	for step, result in results['steps'].items():
+		print(' ', step.ljust(7), ('%.3fs' % result['min']).rjust(9), ('%.3fs' % result['median']).rjust(9))
+	print('Results written to', output_file)
+
+if __name__ == '__main__':
+	main()
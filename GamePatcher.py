@@ -6,23 +6,28 @@
 import argparse
 import sys
 import re
-from os import system, listdir, makedirs, rename, remove, stat, chmod, name as os_name
-from os.path import join, abspath, basename, splitext, isfile, isdir, getsize
-from shutil import copyfile, copytree, rmtree
+from os import system, environ, cpu_count, listdir, makedirs, rename, replace, remove, link, symlink, stat, chmod, SEEK_END, name as os_name
+from os.path import expanduser, join, abspath, basename, split, splitext, isfile, isdir, lexists, getsize, samefile
+from shutil import copyfile, copyfileobj, rmtree, disk_usage
 from stat import S_IXUSR, S_IXGRP, S_IXOTH
-from io import BytesIO
-from zipfile import ZipFile
-from tarfile import open as TarFile
+from io import StringIO
 import json
-from subprocess import run, STDOUT, PIPE
-from urllib.request import urlopen
-import webbrowser
+import struct
+from subprocess import CompletedProcess, STDOUT, PIPE, DEVNULL
+import hashlib
+import zlib
+from mmap import mmap, ACCESS_READ
 import platform
-import ssl
+import threading
+from queue import Queue, Empty
+from contextlib import contextmanager, nullcontext
+from time import time, perf_counter, thread_time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 VERSION = 'v1.1.3'
 REPOSITORY = r'Ich73/GamePatcher'
 
+# the downloads of each platform can be pinned by adding their 'sha256' hash
 TOOLS = {
 	'xdelta': {
 		'version': '3.1.0',
@@ -50,35 +55,41 @@ TOOLS = {
 	}
 }
 
+# the partition containing each file that can be patched, except the files in ExtractedExeFS
+PARTITIONS = {
+	'DecryptedRomFS.bin': 0, 'DecryptedExHeader.bin': 0, 'HeaderNCCH0.bin': 0, 'LogoLZ.bin': 0, 'PlainRGN.bin': 0,
+	'DecryptedManual.bin': 1, 'HeaderNCCH1.bin': 1,
+	'DecryptedDownloadPlay.bin': 2, 'HeaderNCCH2.bin': 2
+}
+
 
 ###########
 ## Setup ##
 ###########
 
-# set windows taskbar icon
-try:
-	from ctypes import windll
-	appid = 'gamepatcher.' + VERSION
-	windll.shell32.SetCurrentProcessExplicitAppUserModelID(appid)
-except: pass
+def setTaskbarIcon():
+	""" Sets the windows taskbar icon. """
+	try:
+		from ctypes import windll
+		appid = 'gamepatcher.' + VERSION
+		windll.shell32.SetCurrentProcessExplicitAppUserModelID(appid)
+	except: pass
 
 
 #############
 ## Updates ##
 #############
 
-def checkUpdates():
-	def printCategory(text):
-		print(' '*m + '~ ' + text + ' ~')
-		print()
-	
-	def printOption(cmd, text):
-		print(' '*m + '*', cmd, ':', text)
-	
+def latestRelease():
+	""" Queries the latest release of Game Patcher.
+		Returns its tag and link if it is newer than the current version, returns None otherwise or if the query failed.
+	"""
 	try:
 		# query api
+		import ssl
+		from urllib.request import urlopen
 		latest = r'https://api.github.com/repos/%s/releases/latest' % REPOSITORY
-		with urlopen(latest, timeout = 1, context=ssl._create_unverified_context()) as url:
+		with urlopen(latest, timeout = 5, context=ssl._create_unverified_context()) as url:
 			data = json.loads(url.read().decode(errors='replace'))
 		tag = data['tag_name']
 		link = data['html_url']
@@ -90,7 +101,23 @@ def checkUpdates():
 			return sum([int(k) * 100**(len(v)-i) for i, k in enumerate(v)])
 		current_version = ver2int(VERSION)
 		tag_version     = ver2int(tag)
-		if current_version >= tag_version: return
+		if current_version >= tag_version: return None
+		return tag, link
+	except Exception: return None
+
+def checkUpdates(release):
+	""" Shows the [release] returned by latestRelease and asks whether it should be downloaded.
+		Returns True if the download page was opened.
+	"""
+	def printCategory(text):
+		print(' '*m + '~ ' + text + ' ~')
+		print()
+	
+	def printOption(cmd, text):
+		print(' '*m + '*', cmd, ':', text)
+	
+	try:
+		tag, link = release
 		
 		# show message
 		printTitleBox()
@@ -112,12 +139,910 @@ def checkUpdates():
 		script = command.upper() if command else ''
 		
 		if script == 'D':
+			import webbrowser
 			webbrowser.open(link)
 			return True
 		elif script == 'C': pass
 	except Exception: pass
 
 
+##############
+## Parallel ##
+##############
+
+class BufferedOutput:
+	""" Replaces sys.stdout to collect the output of each worker thread in the buffer of its task.
+		Threads without a task or whose task has no buffer write directly to the original [stream].
+	"""
+	def __init__(self, stream):
+		self.stream = stream
+		self.local = threading.local()
+		self.lock = threading.Lock()
+	
+	def target(self):
+		task = getattr(self.local, 'task', None)
+		return self.stream if task is None or task['buffer'] is None else task['buffer']
+	
+	def write(self, text):
+		with self.lock: return self.target().write(text)
+	
+	def flush(self):
+		with self.lock:
+			if self.target() is self.stream: self.stream.flush()
+	
+	def release(self, task):
+		""" Writes the output buffered for [task] and lets it write directly from now on. """
+		with self.lock:
+			self.stream.write(task['buffer'].getvalue())
+			self.stream.flush()
+			task['buffer'] = None
+	
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+def runGraph(tasks, limits):
+	""" Runs each of the [tasks] as soon as all of its dependencies have succeeded.
+		[tasks] maps a name to a tuple (func, dependencies, kind) and [limits] maps each kind
+		to the number of tasks of this kind that run at the same time. Tasks are started in the order of [tasks].
+		The oldest running task prints directly, the output of the tasks running alongside it is buffered
+		and printed when it is finished, then the next oldest running task prints directly.
+		Returns a dict mapping each name to True if the task succeeded, False if it failed
+		and None if it was skipped because one of its dependencies did not succeed.
+	"""
+	stdout = sys.stdout
+	sys.stdout = output = BufferedOutput(stdout)
+	def call(name, task):
+		output.local.task = task
+		try:
+			try: return bool(tasks[name][0]())
+			except Exception as e:
+				print(str(e).strip())
+				return False
+		finally: output.local.task = None
+	try:
+		results = dict()
+		pending = list(tasks)
+		running = dict()
+		live, outputs, finished = None, dict(), list()
+		with ThreadPoolExecutor(max_workers=max(sum(limits.values()), 1)) as executor:
+			while pending or running:
+				# skip tasks whose dependencies did not succeed
+				for name in pending:
+					if any(dependency in results and not results[dependency] for dependency in tasks[name][1]): results[name] = None
+				pending = [name for name in pending if name not in results]
+				# start tasks whose dependencies succeeded
+				for name in list(pending):
+					_, dependencies, kind = tasks[name]
+					if not all(results.get(dependency) for dependency in dependencies): continue
+					if sum(1 for other in running.values() if tasks[other][2] == kind) >= limits[kind]: continue
+					outputs[name] = {'buffer': StringIO() if live is not None else None}
+					if live is None: live = name
+					running[executor.submit(call, name, outputs[name])] = name
+					pending.remove(name)
+				if not running: break # the remaining tasks depend on unknown tasks
+				# wait for the next task to finish, the running tools are killed on Ctrl+C so the threads can finish
+				try: done, _ = wait(running, return_when=FIRST_COMPLETED)
+				except KeyboardInterrupt:
+					TOOL_RUNNER.stop()
+					raise
+				for future in sorted(done, key=lambda future: list(tasks).index(running[future])):
+					name = running.pop(future)
+					results[name] = future.result()
+					if name == live: live = None
+					else: finished.append(outputs[name])
+				# print the tasks that finished alongside the live task and let the oldest running task print directly
+				if live is None:
+					for task in finished: stdout.write(task['buffer'].getvalue())
+					stdout.flush()
+					finished.clear()
+					if running:
+						live = next(iter(running.values()))
+						output.release(outputs[live])
+		for name in pending: results[name] = None
+		return results
+	finally: sys.stdout = stdout
+
+
+###############
+## Processes ##
+###############
+
+class ToolRunner:
+	""" Runs the external tools without a shell on an asyncio event loop in a background thread.
+		At most [limit] tools run at the same time and each tool is killed after [timeout] seconds.
+		The output of each tool is printed line by line by the thread that started it while the tool is running.
+	"""
+	def __init__(self, limit = 1, timeout = None):
+		self.limit = limit
+		self.timeout = timeout
+		self.loop = None
+		self.slots = None
+		self.procs = set()
+		self.stopped = False
+		self.lock = threading.Lock()
+	
+	def start(self, argv, cwd, stdin, stdout, timeout, lines, label):
+		""" Starts the tool [argv] and returns a future of its CompletedProcess.
+			Each line of its output is put into the queue [lines] together with [label].
+		"""
+		import asyncio
+		with self.lock:
+			if self.loop is None:
+				self.loop = asyncio.new_event_loop()
+				threading.Thread(target=self.loop.run_forever, daemon=True).start()
+		return asyncio.run_coroutine_threadsafe(self.call(argv, cwd, stdin, stdout, timeout, lines, label), self.loop)
+	
+	async def call(self, argv, cwd, stdin, stdout, timeout, lines, label):
+		import asyncio
+		if self.slots is None: self.slots = asyncio.Semaphore(max(self.limit, 1))
+		async with self.slots:
+			if self.stopped: raise InterruptedError('Interrupted')
+			proc = await asyncio.create_subprocess_exec(*argv, cwd=cwd, stdin=PIPE if stdin is not None else DEVNULL, \
+				stdout=stdout if stdout is not None else PIPE, stderr=PIPE if stdout is not None else STDOUT)
+			self.procs.add(proc)
+			async def feed():
+				try:
+					while True:
+						data = await self.loop.run_in_executor(None, stdin.read, 2**20)
+						if not data: break
+						proc.stdin.write(data)
+						await proc.stdin.drain()
+				except (BrokenPipeError, ConnectionResetError): pass # the tool stopped reading, the error is in its output
+				finally: proc.stdin.close()
+			async def read(stream):
+				output = bytearray()
+				rest = b''
+				while True:
+					data = await stream.read(2**16)
+					if not data: break
+					output += data
+					*complete, rest = re.split(rb'[\r\n]', rest + data)
+					for line in complete: lines.put((label, line))
+				lines.put((label, rest))
+				return bytes(output)
+			async def communicate():
+				if stdin is not None: _, output = await asyncio.gather(feed(), read(proc.stderr if stdout is not None else proc.stdout))
+				else: output = await read(proc.stderr if stdout is not None else proc.stdout)
+				await proc.wait()
+				return output
+			try:
+				output = await asyncio.wait_for(communicate(), timeout or None)
+				if self.stopped: raise InterruptedError('Interrupted')
+				return CompletedProcess(argv, proc.returncode, output)
+			except asyncio.TimeoutError: raise TimeoutError('%s did not finish within %d seconds' % (basename(argv[0]), timeout))
+			finally:
+				self.procs.discard(proc)
+				if proc.returncode is None:
+					proc.kill()
+					await proc.wait()
+	
+	def run(self, commands, cwd = None, stdin = None, stdout = None, timeout = None, echo = True):
+		""" Runs all [commands] at the same time and returns a dict mapping each name to its CompletedProcess.
+			[commands] maps a name to the argument list of a tool. The output of a tool is written to [stdout] if given
+			and read from its stderr otherwise. [stdin] is a file object the input is read from.
+			If [echo] is True each line of the output is printed, prefixed with the name if there are several commands.
+			Raises TimeoutError if a tool runs longer than [timeout] or the default timeout.
+		"""
+		lines = Queue()
+		futures = {name: self.start(argv, cwd, stdin, stdout, timeout if timeout is not None else self.timeout, lines, name if len(commands) > 1 else None) \
+			for name, argv in commands.items()}
+		try:
+			while True:
+				try: label, line = lines.get(timeout=0.1)
+				except Empty:
+					if all(future.done() for future in futures.values()) and lines.empty(): break
+					continue
+				line = line.decode(errors='replace').rstrip()
+				if echo and line: print(' ', ' ', *([label + ':'] if label else []), line)
+			return {name: future.result() for name, future in futures.items()}
+		except KeyboardInterrupt:
+			self.stop()
+			raise
+	
+	def stop(self):
+		""" Kills all running tools and lets all further calls fail. """
+		self.stopped = True
+		if self.loop is None: return
+		def kill():
+			for proc in list(self.procs):
+				if proc.returncode is None: proc.kill()
+		self.loop.call_soon_threadsafe(kill)
+
+# runs every external tool, see --tool-jobs and --tool-timeout
+TOOL_RUNNER = ToolRunner(limit=cpu_count() or 1)
+
+def runTool(argv, cwd = None, stdin = None, stdout = None, timeout = None, echo = True):
+	""" Runs the tool [argv] using TOOL_RUNNER and returns its CompletedProcess. """
+	return TOOL_RUNNER.run({'': argv}, cwd=cwd, stdin=stdin, stdout=stdout, timeout=timeout, echo=echo)['']
+
+
+#############
+## Profile ##
+#############
+
+# the active profile, see --profile
+PROFILE = None
+
+class Profile:
+	""" Records the wall time, the CPU time of this thread and of child processes, the bytes read and written
+		and the peak disk usage of [paths] for each step of each task.
+		The child CPU time and the bytes read and written are counted for the whole process,
+		so they include other steps that ran at the same time, which is recorded as 'concurrent'.
+	"""
+	def __init__(self, paths, interval = 0.5):
+		self.paths = paths
+		self.interval = interval
+		self.steps = list()
+		self.open = dict() # thread -> open step
+		self.peak = 0
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.stopped = threading.Event()
+		self.sampler = threading.Thread(target=self.sample, daemon=True)
+	
+	def __enter__(self):
+		self.sampler.start()
+		return self
+	
+	def __exit__(self, *args):
+		self.stopped.set()
+		self.sampler.join()
+	
+	def counters(self):
+		""" Returns the current values of the counters that are recorded as the difference between the start and the end of a step. """
+		counters = {'wall': perf_counter(), 'cpu': thread_time(), 'child_cpu': None, 'read_bytes': None, 'write_bytes': None}
+		try:
+			import resource
+			usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+			counters['child_cpu'] = usage.ru_utime + usage.ru_stime
+		except ImportError: pass
+		try: # linux counts the bytes of waited for child processes as well
+			with open('/proc/self/io', 'r') as file: io = dict(line.split(': ') for line in file.read().splitlines())
+			counters['read_bytes'], counters['write_bytes'] = int(io['read_bytes']), int(io['write_bytes'])
+		except (OSError, KeyError, ValueError): pass
+		return counters
+	
+	def sample(self):
+		""" Updates the peak disk usage every [interval] seconds until the profile is stopped. """
+		while True:
+			usage = diskUsage(self.paths)
+			with self.lock:
+				self.peak = max(self.peak, usage)
+				for step in self.open.values(): step['peak_disk'] = max(step['peak_disk'], usage)
+			if self.stopped.wait(self.interval): break
+	
+	@contextmanager
+	def task(self, name):
+		""" Records the steps of the task [name] running in the current thread. """
+		self.local.task = name
+		try: yield
+		finally:
+			self.step(None)
+			self.local.task = None
+	
+	def step(self, name):
+		""" Ends the current step of the task running in the current thread and starts the step [name] unless it is None. """
+		task = getattr(self.local, 'task', None)
+		if task is None: return
+		usage = diskUsage(self.paths)
+		thread = threading.get_ident()
+		with self.lock:
+			end = self.counters()
+			step = self.open.pop(thread, None)
+			if step is not None:
+				start = step.pop('start')
+				for counter, value in end.items():
+					step[counter] = value - start[counter] if value is not None and start[counter] is not None else None
+				step['peak_disk'] = max(step['peak_disk'], usage)
+				self.steps.append(step)
+			if name is not None:
+				for other in self.open.values(): other['concurrent'] = True
+				self.open[thread] = {'task': task, 'step': name, 'start': end, 'peak_disk': usage, 'concurrent': bool(self.open)}
+			self.peak = max(self.peak, usage)
+	
+	def write(self, filename):
+		""" Writes all finished steps and the peak disk usage to the json file [filename]. """
+		with open(filename, 'w') as file:
+			json.dump({'steps': self.steps, 'peak_disk': self.peak}, file, indent=2)
+	
+	def printSummary(self, count = 10):
+		""" Prints the [count] steps with the longest wall time. """
+		def size(value): return formatSize(value) if value is not None else '-'
+		def time(value): return '%.2fs' % value if value is not None else '-'
+		print(' ', 'Wall'.rjust(8), 'Child CPU'.rjust(9), 'Written'.rjust(11), 'Peak Disk'.rjust(11), ' Step')
+		for step in sorted(self.steps, key=lambda step: step['wall'], reverse=True)[:count]:
+			print(' ', time(step['wall']).rjust(8), time(step['child_cpu']).rjust(9), size(step['write_bytes']).rjust(11), size(step['peak_disk']).rjust(11), ' %s: %s' % (step['task'], step['step']))
+		print(' ', 'Peak disk usage', size(self.peak))
+
+def printStep(text):
+	""" Prints the name of the step [text] and starts it in the active profile. """
+	print(text)
+	if PROFILE is not None: PROFILE.step(text)
+
+
+###########
+## Delta ##
+###########
+
+def vcdiffCodeTable():
+	""" Returns the default instruction code table of RFC 3284.
+		Each entry contains one or two instructions as (type, size, mode) with the types ADD 1, RUN 2 and COPY 3.
+	"""
+	ADD, RUN, COPY = 1, 2, 3
+	table = [((RUN, 0, 0),)]
+	table += [((ADD, size, 0),) for size in range(18)]
+	for mode in range(9): table += [((COPY, size, mode),) for size in [0] + list(range(4, 19))]
+	for mode in range(6): table += [((ADD, add, 0), (COPY, copy, mode)) for add in range(1, 5) for copy in range(4, 7)]
+	for mode in range(6, 9): table += [((ADD, add, 0), (COPY, 4, mode)) for add in range(1, 5)]
+	table += [((COPY, 4, mode), (ADD, 1, 0)) for mode in range(9)]
+	return table
+
+def vcdiffSupported(header):
+	""" Returns whether the first 6 bytes of a delta given as [header] can be applied with decodeVCDiff. """
+	if header[:3] != b'\xd6\xc3\xc4' or len(header) < 5: return False
+	if header[4] & 0x02: return False # custom code table
+	if header[4] & 0x01 and (len(header) < 6 or header[5] != 2): return False # secondary compressor other than lzma
+	return True
+
+def needsXdelta(patch_file, patches, native_limit):
+	""" Returns whether any patch in [patch_file] listed in [patches] or patching a file in the RomFS is larger than [native_limit] bytes
+		or uses an extension that decodeVCDiff does not support.
+	"""
+	from zipfile import ZipFile
+	with ZipFile(patch_file, 'r') as file:
+		patches = filePatches(file.namelist(), patches)
+		for info in file.infolist():
+			if info.is_dir() or info.filename not in patches: continue
+			if info.file_size > native_limit: return True
+			with file.open(info) as member:
+				if not vcdiffSupported(member.read(6)): return True
+	return False
+
+def decodeVCDiff(patch, source_file, target_file):
+	""" Applies the VCDIFF delta (RFC 3284) read from the file object [patch] to [source_file] and writes [target_file].
+		The source is accessed through mmap and the target is written window by window.
+		Supports the xdelta3 extensions for application headers, Adler-32 checksums and lzma secondary compression.
+		Raises a NotImplementedError for other extensions and a ValueError if the delta is invalid or the checksum does not match.
+	"""
+	def read(size):
+		data = patch.read(size)
+		if len(data) != size: raise ValueError('Unexpected end of delta')
+		return data
+	def integer():
+		value = 0
+		while True:
+			byte = read(1)[0]
+			value = (value << 7) | (byte & 0x7F)
+			if not byte & 0x80: return value
+	def varint(data, pos):
+		value = 0
+		while True:
+			byte = data[pos]
+			pos += 1
+			value = (value << 7) | (byte & 0x7F)
+			if not byte & 0x80: return value, pos
+	
+	# header
+	if read(4)[:3] != b'\xd6\xc3\xc4': raise ValueError('Not a VCDIFF delta')
+	indicator = read(1)[0]
+	compressor = read(1)[0] if indicator & 0x01 else None
+	if indicator & 0x02: raise NotImplementedError('Custom code tables are not supported')
+	if indicator & 0x04: read(integer()) # application header
+	if compressor is not None and compressor != 2: raise NotImplementedError('Secondary compressor %d is not supported' % compressor)
+	table = vcdiffCodeTable()
+	
+	# xdelta3 compresses each kind of section as one xz stream over the whole delta and only flushes it after each window
+	decompressors = dict()
+	def decompress(kind, section):
+		if compressor is None: raise ValueError('Compressed section without secondary compressor')
+		if kind not in decompressors:
+			import lzma
+			decompressors[kind] = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+		size, pos = varint(section, 0)
+		section = decompressors[kind].decompress(section[pos:])
+		if len(section) != size: raise ValueError('Invalid compressed section')
+		return section
+	
+	with open(source_file, 'rb') as src, open(target_file, 'w+b') as out:
+		source = mmap(src.fileno(), 0, access=ACCESS_READ) if getsize(source_file) else b''
+		view = memoryview(source)
+		segment = b''
+		try:
+			while True:
+				# window header
+				window = patch.read(1)
+				if not window: break
+				window = window[0]
+				segment_size, segment_pos = (integer(), integer()) if window & 0x03 else (0, 0)
+				delta = read(integer())
+				target_size, pos = varint(delta, 0)
+				sections = delta[pos]
+				data_size, pos = varint(delta, pos+1)
+				inst_size, pos = varint(delta, pos)
+				addr_size, pos = varint(delta, pos)
+				checksum = None
+				if window & 0x04:
+					checksum = int.from_bytes(delta[pos:pos+4], 'big')
+					pos += 4
+				data = delta[pos:pos+data_size]
+				insts = delta[pos+data_size:pos+data_size+inst_size]
+				addrs = delta[pos+data_size+inst_size:pos+data_size+inst_size+addr_size]
+				
+				# secondary compression
+				if sections & 0x01: data = decompress('data', data)
+				if sections & 0x02: insts = decompress('inst', insts)
+				if sections & 0x04: addrs = decompress('addr', addrs)
+				
+				# source segment
+				if window & 0x01: segment = view[segment_pos:segment_pos+segment_size]
+				elif window & 0x02:
+					out.flush()
+					out.seek(segment_pos)
+					segment = out.read(segment_size)
+					out.seek(0, SEEK_END)
+				else: segment = b''
+				if len(segment) != segment_size: raise ValueError('Source segment out of range')
+				
+				# instructions
+				target = bytearray()
+				near = [0, 0, 0, 0]
+				next_slot = 0
+				same = [0] * (3*256)
+				d = i = a = 0
+				while i < len(insts):
+					code = table[insts[i]]
+					i += 1
+					for type, size, mode in code:
+						if size == 0: size, i = varint(insts, i)
+						if type == 1: # ADD
+							target += data[d:d+size]
+							d += size
+						elif type == 2: # RUN
+							target += data[d:d+1] * size
+							d += 1
+						else: # COPY
+							here = segment_size + len(target)
+							if mode == 0: addr, a = varint(addrs, a)
+							elif mode == 1:
+								addr, a = varint(addrs, a)
+								addr = here - addr
+							elif mode < 6:
+								addr, a = varint(addrs, a)
+								addr += near[mode-2]
+							else:
+								addr = same[(mode-6)*256 + addrs[a]]
+								a += 1
+							near[next_slot] = addr
+							next_slot = (next_slot + 1) % 4
+							same[addr % (3*256)] = addr
+							if addr < 0 or addr >= here: raise ValueError('Invalid copy address')
+							if addr < segment_size:
+								part = min(size, segment_size - addr)
+								target += segment[addr:addr+part]
+								addr += part
+								size -= part
+							if size:
+								start = addr - segment_size
+								if start + size <= len(target): target += target[start:start+size]
+								else: # overlapping copy repeats the bytes from start to the end of the target
+									pattern = bytes(target[start:])
+									target += (pattern * (size // len(pattern) + 1))[:size]
+				
+				# write window
+				if len(target) != target_size: raise ValueError('Invalid target window size')
+				if checksum is not None and zlib.adler32(target) != checksum: raise ValueError('Target window checksum mismatch')
+				out.write(target)
+		finally:
+			if isinstance(segment, memoryview): segment.release()
+			view.release()
+			if isinstance(source, mmap): source.close()
+
+
+###########
+## ExeFS ##
+###########
+
+def exefsFileName(name):
+	""" Returns the name of the extracted file for the ExeFS section [name]. """
+	return 'code.bin' if name == '.code' else name + '.bin'
+
+def exefsEntries(header):
+	""" Returns the used entries of the ExeFS [header] as a list of (index, name, offset, size). """
+	entries = list()
+	for i in range(10):
+		name, offset, size = header[i*0x10:i*0x10+8], int.from_bytes(header[i*0x10+8:i*0x10+12], 'little'), int.from_bytes(header[i*0x10+12:i*0x10+16], 'little')
+		name = name.rstrip(b'\0').decode('ascii')
+		if name: entries.append((i, name, offset, size))
+	return entries
+
+def unpackExeFS(exefs_file, exefs_dir, header_file):
+	""" Extracts the files of the decrypted [exefs_file] into [exefs_dir] and writes its 0x200 bytes header to [header_file].
+		The files are written directly from a memory map of [exefs_file].
+	"""
+	with open(exefs_file, 'rb') as file, mmap(file.fileno(), 0, access=ACCESS_READ) as exefs:
+		header = exefs[:0x200]
+		if len(header) != 0x200: raise ValueError('Invalid ExeFS: %s' % exefs_file)
+		makedirs(exefs_dir, exist_ok=True)
+		with open(header_file, 'wb') as file: file.write(header)
+		with memoryview(exefs) as view:
+			for _, name, offset, size in exefsEntries(header):
+				if 0x200 + offset + size > len(exefs): raise ValueError('Invalid ExeFS entry: %s' % name)
+				with open(join(exefs_dir, exefsFileName(name)), 'wb') as file, view[0x200+offset:0x200+offset+size] as data: file.write(data)
+
+def packExeFS(exefs_dir, header_file, exefs_file):
+	""" Creates [exefs_file] from the files in [exefs_dir] using the entries of the original [header_file].
+		Recalculates the offsets, sizes and SHA-256 hashes. The file is replaced only when it is complete.
+	"""
+	with open(header_file, 'rb') as file: header = bytearray(file.read(0x200))
+	if len(header) != 0x200: raise ValueError('Invalid ExeFS header: %s' % header_file)
+	with open(exefs_file + '.part', 'wb') as exefs:
+		exefs.write(header)
+		offset = 0
+		for i, name, _, _ in exefsEntries(header):
+			with open(join(exefs_dir, exefsFileName(name)), 'rb') as file: data = file.read()
+			header[i*0x10+8:i*0x10+16] = offset.to_bytes(4, 'little') + len(data).to_bytes(4, 'little')
+			header[0x1E0-i*0x20:0x200-i*0x20] = hashlib.sha256(data).digest() # hashes are stored in reverse order
+			exefs.write(data)
+			exefs.write(bytes(-len(data) % 0x200))
+			offset += len(data) + -len(data) % 0x200
+		exefs.seek(0)
+		exefs.write(header)
+	replace(exefs_file + '.part', exefs_file)
+
+
+###########
+## RomFS ##
+###########
+
+def hashBlocks(data, block_size):
+	""" Returns the SHA-256 hashes of the blocks of [data], the last block is padded with zeros. """
+	hashes = list()
+	with memoryview(data) as view:
+		for pos in range(0, len(data), block_size):
+			hash = hashlib.sha256(view[pos:pos+block_size])
+			if pos + block_size > len(data): hash.update(bytes(pos + block_size - len(data)))
+			hashes.append(hash.digest())
+	return b''.join(hashes)
+
+def romfsLevels(sizes, blocks):
+	""" Returns the layout of a RomFS whose levels 1, 2 and 3 have the given [sizes] and [blocks] sizes.
+		The IVFC header is followed by the master hash at 0x60, level 3, level 1 and level 2,
+		each level starts at a multiple of its block size and each hash is the SHA-256 of a block of the next level.
+	"""
+	align = lambda value, size: -(-value // size) * size
+	master = -(-sizes[0] // blocks[0]) * 0x20
+	level3 = align(0x60 + master, blocks[2])
+	level1 = align(level3 + sizes[2], blocks[2])
+	level2 = align(level1 + sizes[0], blocks[0])
+	logical = [0, align(sizes[0], blocks[1]), align(align(sizes[0], blocks[1]) + sizes[1], blocks[2])]
+	return {'master': master, 'offsets': [level1, level2, level3], 'logical': logical, 'sizes': list(sizes), 'blocks': list(blocks), 'end': level2 + sizes[1]}
+
+def romfsLayout(romfs_file):
+	""" Reads the IVFC header of the decrypted [romfs_file] and returns its layout as defined in romfsLevels
+		together with the header of level 3. Raises a ValueError if the RomFS is laid out differently or its hashes do not match.
+	"""
+	with open(romfs_file, 'rb') as file:
+		header = file.read(0x60)
+		if len(header) != 0x60 or header[:4] != b'IVFC' or struct.unpack_from('<I', header, 4)[0] != 0x10000: raise ValueError('Not a RomFS: %s' % romfs_file)
+		levels = [struct.unpack_from('<QQI', header, pos) for pos in [0x0C, 0x24, 0x3C]]
+		if any(not 6 <= level[2] < 32 for level in levels): raise ValueError('Unsupported RomFS block size: %s' % romfs_file)
+		layout = romfsLevels([level[1] for level in levels], [1 << level[2] for level in levels])
+		(o1, o2, o3), (s1, s2, s3), (b1, b2, b3) = layout['offsets'], layout['sizes'], layout['blocks']
+		padded = -(-layout['end'] // b2) * b2
+		if struct.unpack_from('<I', header, 8)[0] != layout['master'] or [level[0] for level in levels] != layout['logical'] \
+		   or s1 != -(-s2 // b2) * 0x20 or s2 != -(-s3 // b3) * 0x20 or getsize(romfs_file) not in [layout['end'], padded]:
+			raise ValueError('Unsupported RomFS layout: %s' % romfs_file)
+		layout['padded'] = getsize(romfs_file) == padded
+		# check the hashes of the levels 1 and 2 and of the first block of level 3
+		master = file.read(layout['master'])
+		file.seek(o1)
+		level1 = file.read(s1)
+		file.seek(o2)
+		level2 = file.read(s2)
+		file.seek(o3)
+		block = file.read(b3)
+		if hashBlocks(level1, b1) != master or hashBlocks(level2, b2) != level1 or hashBlocks(block[:s3], b3) != level2[:0x20]:
+			raise ValueError('Unsupported RomFS layout, the hashes do not match: %s' % romfs_file)
+		# header length, offset and size of the directory hash table, the directory table, the file hash table and the file table, offset of the file data
+		layout['level3'] = struct.unpack_from('<10I', block)
+		length, *tables, data = layout['level3']
+		if length != 0x28 or any(offset + size > data for offset, size in zip(tables[::2], tables[1::2])) or data > s3:
+			raise ValueError('Unsupported RomFS layout: %s' % romfs_file)
+	return layout
+
+def romfsFiles(romfs_file, layout):
+	""" Reads the directory and file tables of level 3 of the [romfs_file] with the given [layout].
+		Returns the files as a dict of path → (entry, offset, size), where entry is the position of the entry in the file table
+		and offset the position of the data in level 3. The directories in the path are separated by '/'.
+	"""
+	_, _, _, dirs_offset, dirs_size, _, _, files_offset, files_size, data = layout['level3']
+	with open(romfs_file, 'rb') as file:
+		file.seek(layout['offsets'][2] + dirs_offset)
+		dirs = file.read(dirs_size)
+		file.seek(layout['offsets'][2] + files_offset)
+		table = file.read(files_size)
+	try:
+		files, visited = dict(), set()
+		stack = [(0, '')]
+		while stack:
+			dir, path = stack.pop()
+			if dir in visited: raise ValueError('loop')
+			visited.add(dir)
+			_, _, child, entry, _, _ = struct.unpack_from('<6I', dirs, dir)
+			while entry != 0xFFFFFFFF:
+				_, sibling, offset, size, _, length = struct.unpack_from('<IIQQII', table, entry)
+				name = path + table[entry+0x20:entry+0x20+length].decode('utf-16-le')
+				if name in files or data + offset + size > layout['sizes'][2]: raise ValueError('data')
+				files[name] = (entry, data + offset, size)
+				if len(files) > len(table) // 0x20: raise ValueError('loop')
+				entry = sibling
+			while child != 0xFFFFFFFF:
+				_, sibling, _, _, _, length = struct.unpack_from('<6I', dirs, child)
+				stack.append((child, path + dirs[child+0x18:child+0x18+length].decode('utf-16-le') + '/'))
+				child = sibling
+				if len(stack) > len(dirs) // 0x18: raise ValueError('loop')
+	except (ValueError, struct.error, UnicodeDecodeError): raise ValueError('Unsupported RomFS layout, invalid file tables: %s' % romfs_file)
+	return files
+
+def extractRomFS(romfs_file, paths, romfs_dir):
+	""" Extracts the files with the given [paths] from level 3 of the decrypted [romfs_file] into [romfs_dir]. """
+	layout = romfsLayout(romfs_file)
+	files = romfsFiles(romfs_file, layout)
+	for path in paths:
+		if path not in files: raise ValueError('No such file in the RomFS: %s' % path)
+	with open(romfs_file, 'rb', buffering=0) as src:
+		for path in paths:
+			target = join(romfs_dir, *path.split('/'))
+			makedirs(split(target)[0], exist_ok=True)
+			with open(target, 'wb', buffering=0) as dst: copyRange(src, dst, layout['offsets'][2] + files[path][1], files[path][2])
+
+def rebuildRomFS(romfs_file, files, target_file):
+	""" Creates [target_file] from the decrypted [romfs_file] with the files in level 3 replaced by [files], a dict of path → file.
+		The data of the unchanged files is copied by range and only moved by whole blocks, so the hashes of its blocks are taken
+		from level 2 and only the blocks with changed data or entries are hashed again. The file is replaced only when it is complete.
+	"""
+	layout = romfsLayout(romfs_file)
+	entries = romfsFiles(romfs_file, layout)
+	for path in files:
+		if path not in entries: raise ValueError('No such file in the RomFS: %s' % path)
+	(o1, o2, o3), (s1, s2, s3), (b1, b2, b3) = layout['offsets'], layout['sizes'], layout['blocks']
+	_, _, _, _, _, _, _, files_offset, files_size, data = layout['level3']
+	align = lambda value, size: -(-value // size) * size
+	
+	# place the data in its original order, the data after a patched file is moved by whole blocks
+	order = sorted(entries, key=lambda path: entries[path][1:])
+	copies = [(0, 0, entries[order[0]][1] if order else s3)] # (new position, old position, size) in level 3
+	places = dict() # path → (new position, new size)
+	shift, end, previous, old_end = 0, copies[0][2], False, 0
+	for i, path in enumerate(order):
+		_, offset, size = entries[path]
+		following = entries[order[i+1]][1] if i + 1 < len(order) else s3
+		if offset < old_end: raise ValueError('Unsupported RomFS layout, files share data: %s' % romfs_file)
+		old_end = offset + size
+		if previous: shift += align(align(end, 0x10) - (offset + shift), b3) # can be negative if the patched file got smaller
+		if path in files:
+			places[path] = (offset + shift, getsize(files[path]))
+			end, previous = offset + shift + places[path][1], True
+			if i + 1 == len(order): end += s3 - old_end # keep the padding at the end
+		else:
+			places[path] = (offset + shift, size)
+			pos, old, length = copies[-1]
+			if pos - old == shift and old + length == offset: copies[-1] = (pos, old, following - old) # one range for consecutive files
+			else: copies.append((offset + shift, offset, following - offset))
+			end, previous = following + shift, False
+	new = romfsLevels([align(align(end, b3) // b3 * 0x20, b2) // b2 * 0x20, align(end, b3) // b3 * 0x20, end], layout['blocks'])
+	n1, n2, n3 = new['offsets']
+	
+	# file table with the new positions and sizes
+	with open(romfs_file, 'rb') as file:
+		file.seek(o3 + files_offset)
+		table = bytearray(file.read(files_size))
+		file.seek(o2)
+		old_level2 = file.read(s2)
+		file.seek(0)
+		header = bytearray(file.read(0x60))
+	for path, (offset, size) in places.items():
+		struct.pack_into('<QQ', table, entries[path][0] + 8, offset - data, size)
+	
+	with open(romfs_file, 'rb', buffering=0) as src, open(target_file + '.part', 'wb+', buffering=0) as dst:
+		# level 3, the gaps are left as holes which read as zeros
+		for pos, old, size in copies:
+			if not size: continue
+			dst.seek(n3 + pos)
+			copyRange(src, dst, o3 + old, size)
+		for path, file in files.items():
+			with open(file, 'rb', buffering=0) as patched:
+				dst.seek(n3 + places[path][0])
+				copyRange(patched, dst, 0, places[path][1])
+		dst.seek(n3 + files_offset)
+		dst.write(table)
+		dst.truncate(n3 + end)
+		
+		# level 2, the hashes of the blocks that were moved as a whole are reused
+		count = align(end, b3) // b3
+		level2, hashed = bytearray(count * 0x20), bytearray(count)
+		for pos, old, size in copies:
+			if (pos - old) % b3: continue
+			moved = (pos - old) // b3
+			first, last = align(pos, b3) // b3, min((pos + size) // b3, s3 // b3 + moved)
+			if first >= last: continue
+			level2[first*0x20:last*0x20] = old_level2[(first-moved)*0x20:(last-moved)*0x20]
+			hashed[first:last] = bytes([1]) * (last - first)
+		first, last = files_offset // b3, min(align(files_offset + files_size, b3) // b3, count)
+		hashed[first:last] = bytes(last - first) # the entries of the moved files changed
+		block = hashed.find(0)
+		while block != -1:
+			dst.seek(n3 + block * b3)
+			level2[block*0x20:(block+1)*0x20] = hashBlocks(dst.read(min(b3, end - block * b3)), b3)
+			block = hashed.find(0, block + 1)
+		
+		# level 1, master hash and header
+		level1 = hashBlocks(level2, b2)
+		struct.pack_into('<I', header, 8, new['master'])
+		for pos, logical, size in zip([0x0C, 0x24, 0x3C], new['logical'], new['sizes']):
+			struct.pack_into('<QQ', header, pos, logical, size)
+		dst.seek(0)
+		dst.write(header + hashBlocks(level1, b1))
+		dst.seek(n1)
+		dst.write(level1)
+		dst.seek(n2)
+		dst.write(level2)
+		dst.truncate(align(new['end'], b2) if layout['padded'] else new['end'])
+	replace(target_file + '.part', target_file)
+
+
+################
+## Containers ##
+################
+
+def copyRange(src, dst, offset, size, chunk_size = 2**24):
+	""" Copies [size] bytes at [offset] of the unbuffered file object [src] to the current position of [dst].
+		Uses copy_file_range or sendfile so the data is copied by the kernel and falls back to copying chunks.
+	"""
+	import os # copy_file_range and sendfile are not available on every platform
+	end = offset + size
+	for method in ['copy_file_range', 'sendfile']:
+		if not hasattr(os, method): continue
+		try:
+			while offset < end:
+				if method == 'copy_file_range': copied = os.copy_file_range(src.fileno(), dst.fileno(), min(end - offset, 2**30), offset)
+				else: copied = os.sendfile(dst.fileno(), src.fileno(), offset, min(end - offset, 2**30))
+				if not copied: raise EOFError('Unexpected end of file: %s' % src.name)
+				offset += copied
+			return
+		except OSError: continue # not supported for these files, continue where it stopped
+	buffer = bytearray(chunk_size)
+	src.seek(offset)
+	while offset < end:
+		copied = src.readinto(memoryview(buffer)[:min(end - offset, chunk_size)])
+		if not copied: raise EOFError('Unexpected end of file: %s' % src.name)
+		dst.write(memoryview(buffer)[:copied])
+		offset += copied
+
+def ciaContents(file):
+	""" Reads the header and the TMD of the opened CIA [file] and returns its contents as a list of (index, offset, size).
+		Raises a NotImplementedError if a content is encrypted and a ValueError if the file is not a valid CIA.
+	"""
+	try:
+		header = file.read(0x2020)
+		header_size, _, _, cert_size, ticket_size, tmd_size, _, content_size = struct.unpack_from('<IHHIIIIQ', header)
+		align = lambda size: size + -size % 64
+		tmd_offset = align(header_size) + align(cert_size) + align(ticket_size)
+		file.seek(tmd_offset)
+		tmd = file.read(tmd_size)
+		signature = {0x10000: 0x240, 0x10001: 0x140, 0x10002: 0x80, 0x10003: 0x240, 0x10004: 0x140, 0x10005: 0x80}[int.from_bytes(tmd[:4], 'big')]
+		count = int.from_bytes(tmd[signature+0x9E:signature+0xA0], 'big')
+		contents = list()
+		offset = tmd_offset + align(tmd_size)
+		for i in range(count):
+			_, index, type, size = struct.unpack_from('>IHHQ', tmd, signature + 0xC4 + 0x900 + i*0x30)
+			if not header[0x20 + index // 8] & (0x80 >> index % 8): continue # not included in this file
+			if type & 0x1: raise NotImplementedError('Content %d is encrypted' % index)
+			contents.append((index, offset, size))
+			offset += size
+	except (KeyError, IndexError, struct.error): raise ValueError('Invalid CIA: %s' % file.name)
+	if offset > tmd_offset + align(tmd_size) + content_size or offset > getsize(file.name): raise ValueError('Invalid CIA: %s' % file.name)
+	return contents
+
+def ncsdPartitions(file):
+	""" Reads the header of the opened NCSD [file] and returns its partitions as a list of (index, offset, size).
+		Raises a ValueError if the file is not a valid NCSD.
+	"""
+	header = file.read(0x200)
+	if len(header) != 0x200 or header[0x100:0x104] != b'NCSD': raise ValueError('Invalid 3DS: %s' % file.name)
+	unit = 0x200 << header[0x18E]
+	partitions = list()
+	for index in range(8):
+		offset, size = struct.unpack_from('<II', header, 0x120 + index*8)
+		if size: partitions.append((index, offset * unit, size * unit))
+	if not partitions or max(offset + size for _, offset, size in partitions) > getsize(file.name): raise ValueError('Invalid 3DS: %s' % file.name)
+	return partitions
+
+def splitGame(game_file, game_dir, ids = (0, 1, 2)):
+	""" Writes the partitions [ids] of the decrypted [game_file] to DecryptedPartitionX.bin in [game_dir].
+		For .3ds files the NCSD header up to the first partition is written to HeaderNCCH.bin.
+		Raises a NotImplementedError or a ValueError before writing anything if the file cannot be split.
+	"""
+	with open(game_file, 'rb', buffering=0) as file:
+		mode = splitext(game_file)[1][1:].lower()
+		partitions = ciaContents(file) if mode == 'cia' else ncsdPartitions(file)
+		if mode == '3ds':
+			with open(join(game_dir, 'HeaderNCCH.bin'), 'wb', buffering=0) as header:
+				copyRange(file, header, 0, min(offset for _, offset, _ in partitions))
+		for index, offset, size in partitions:
+			if index not in ids: continue
+			with open(join(game_dir, 'DecryptedPartition%d.bin' % index), 'wb', buffering=0) as partition:
+				copyRange(file, partition, offset, size)
+
+def ncchRegions(partition_file, header):
+	""" Returns the media unit and the regions of the NCCH [partition_file] with the given [header]
+		as a dict mapping 'exh', 'logo', 'plain', 'exefs' and 'romfs' to (offset, size). Regions without data are left out.
+		Raises a ValueError if the file is not a valid NCCH.
+	"""
+	if len(header) != 0x200 or header[0x100:0x104] != b'NCCH': raise ValueError('Invalid NCCH: %s' % partition_file)
+	unit = 0x200 << header[0x18E]
+	regions = {'exh': (0x200, 0x800 if struct.unpack_from('<I', header, 0x180)[0] else 0)} # the extended header and the access descriptor
+	for name, position in [('plain', 0x190), ('logo', 0x198), ('exefs', 0x1A0), ('romfs', 0x1B0)]:
+		offset, size = struct.unpack_from('<II', header, position)
+		regions[name] = (offset * unit, size * unit)
+	regions = {name: region for name, region in regions.items() if region[1]}
+	if any(offset + size > getsize(partition_file) for offset, size in regions.values()): raise ValueError('Invalid NCCH: %s' % partition_file)
+	return unit, regions
+
+def splitNCCH(partition_file, game_dir):
+	""" Writes the header, the extended header, the logo, the plain region and the ExeFS of the decrypted [partition_file]
+		to HeaderNCCH0.bin, DecryptedExHeader.bin, LogoLZ.bin, PlainRGN.bin and DecryptedExeFS.bin in [game_dir] like 3dstool.
+		The RomFS is not extracted, rebuildNCCH copies it from [partition_file].
+	"""
+	names = {'exh': 'DecryptedExHeader.bin', 'logo': 'LogoLZ.bin', 'plain': 'PlainRGN.bin', 'exefs': 'DecryptedExeFS.bin'}
+	with open(partition_file, 'rb', buffering=0) as file:
+		header = file.read(0x200)
+		_, regions = ncchRegions(partition_file, header)
+		with open(join(game_dir, 'HeaderNCCH0.bin'), 'wb') as out: out.write(header)
+		for name, (offset, size) in regions.items():
+			if name not in names: continue
+			with open(join(game_dir, names[name]), 'wb', buffering=0) as out: copyRange(file, out, offset, size)
+
+def rebuildNCCH(partition_file, header_file, files, target_file):
+	""" Rebuilds the decrypted NCCH [partition_file] with the header in [header_file] to [target_file].
+		[files] maps 'exh', 'logo', 'plain' and 'exefs' to the files that replace these regions,
+		all other regions and the RomFS are copied from [partition_file].
+		Each region keeps its offset unless the regions before it have grown, the RomFS is then moved to the next 0x1000 bytes.
+		The offsets, sizes and hashes of the regions and the size of the content are updated in the header.
+	"""
+	with open(partition_file, 'rb', buffering=0) as src, open(target_file, 'w+b', buffering=0) as dst:
+		unit, regions = ncchRegions(partition_file, src.read(0x200))
+		with open(header_file, 'rb') as file: header = bytearray(file.read(0x200))
+		
+		# write the regions in their original order, the header is written last
+		layout = dict()
+		dst.write(bytes(0x200))
+		for name, (offset, size) in sorted(regions.items(), key=lambda region: region[1][0]):
+			size = getsize(files[name]) if name in files else size
+			alignment = max(unit, 0x1000) if name == 'romfs' else unit
+			offset = max(offset, dst.tell() + -dst.tell() % alignment)
+			dst.write(bytes(offset - dst.tell()))
+			if name in files:
+				with open(files[name], 'rb', buffering=0) as file: copyRange(file, dst, 0, size)
+			else: copyRange(src, dst, regions[name][0], size)
+			dst.write(bytes(-size % unit))
+			layout[name] = (offset, size + -size % unit)
+		
+		# update the header
+		def digest(name, size):
+			dst.seek(layout[name][0])
+			return hashlib.sha256(dst.read(size)).digest()
+		for name, position in [('plain', 0x190), ('logo', 0x198), ('exefs', 0x1A0), ('romfs', 0x1B0)]:
+			if name in layout: struct.pack_into('<II', header, position, layout[name][0] // unit, layout[name][1] // unit)
+		struct.pack_into('<I', header, 0x104, dst.seek(0, SEEK_END) // unit)
+		if 'exh' in layout: header[0x160:0x180] = digest('exh', struct.unpack_from('<I', header, 0x180)[0])
+		if 'logo' in layout: header[0x130:0x150] = digest('logo', layout['logo'][1])
+		if 'exefs' in layout: header[0x1C0:0x1E0] = digest('exefs', struct.unpack_from('<I', header, 0x1A8)[0] * unit)
+		if 'romfs' in layout: header[0x1E0:0x200] = digest('romfs', struct.unpack_from('<I', header, 0x1B8)[0] * unit)
+		dst.seek(0)
+		dst.write(header)
+
+
 ##########
 ## Main ##
 ##########
@@ -144,8 +1069,12 @@ def version2int(s):
 def int2version(v):
 	return 'v%d.%d.%d' % (v // 2**10, v % 2**10 // 2**4, v % 2**10 % 2**4)
 
+def chainFiles(patch):
+	""" Returns the list of patch files of a [patch], which is either a patch file or a tuple of chained patch files. """
+	return [patch] if isinstance(patch, str) else list(patch)
+
 def createName(game, patch):
-	return '%s (%s)%s' % (splitext(game)[0], splitext(patch)[0], splitext(game)[1])
+	return '%s (%s)%s' % (splitext(game)[0], '+'.join(splitext(file)[0] for file in chainFiles(patch)), splitext(game)[1])
 
 def escapeName(name):
 	""" Espaces a filename by replacing several characters with underscores. """
@@ -163,8 +1092,12 @@ def automaticMappings():
 		patches = [f for f in listdir('.') if isfile(f) and splitext(f)[1] == '.zip']
 		games = [f for f in listdir('.') if isfile(f) and splitext(f)[1].lower() == type]
 		
-		# remove games that look like already patched games
-		games = [game for game in games if all('(%s)' % splitext(patch)[0] not in game for patch in patches)]
+		# remove games that look like already patched games, chains are named like (Patch+Fix)
+		names = {splitext(patch)[0] for patch in patches}
+		def patched(game):
+			if any('(%s)' % name in game for name in names): return True
+			return any(names & set(chain.split('+')) for chain in re.findall(r'\(([^()]*\+[^()]*)\)', game))
+		games = [game for game in games if not patched(game)]
 		
 		# guess the versions of all patches and games
 		def guessVersions(files): return {file: (re.search(r'v\d\.\d(\.\d)?', file) or [None])[0] for file in files}
@@ -273,10 +1206,51 @@ def askMappings():
 	# return all mappings
 	return mappings
 
-def downloadTool(download_url, filename):
+def downloadFile(download_url, filename, sha256 = None, attempts = 3):
+	""" Downloads the given [download_url] in chunks to [filename].part and renames it to [filename] when finished.
+		Resumes an existing partial download using an HTTP range request.
+		If [sha256] is given the hash of the download is verified before it is renamed.
+	"""
+	import ssl
+	from urllib.request import urlopen, Request
+	from urllib.error import HTTPError
+	from http.client import HTTPException
+	part = filename + '.part'
+	for attempt in range(attempts):
+		offset = getsize(part) if isfile(part) else 0
+		if offset: print('Resuming at', offset, 'bytes')
+		request = Request(download_url, headers={'Range': 'bytes=%d-' % offset} if offset else {})
+		try:
+			with urlopen(request, timeout=30, context=ssl._create_unverified_context()) as url:
+				if url.status != 206: offset = 0 # range not supported, start again
+				with open(part, 'ab' if offset else 'wb') as file:
+					while True:
+						chunk = url.read(2**20)
+						if not chunk: break
+						file.write(chunk)
+				if url.length: raise HTTPException('Connection closed with %d bytes remaining' % url.length)
+			break
+		except HTTPError as e:
+			if e.code == 416 and offset: break # already complete
+			raise
+		except (OSError, HTTPException):
+			if attempt == attempts-1: raise
+	
+	# verify hash
+	hash = hashlib.sha256()
+	with open(part, 'rb') as file:
+		for chunk in iter(lambda: file.read(2**20), b''): hash.update(chunk)
+	if sha256 is not None and hash.hexdigest() != sha256.lower():
+		remove(part)
+		raise Exception('The download of %s is corrupted. Expected SHA-256 %s but got %s.' % (basename(download_url), sha256.lower(), hash.hexdigest()))
+	if sha256 is None: print(' ', 'SHA-256', hash.hexdigest())
+	replace(part, filename)
+
+def downloadTool(download_url, filename, sha256 = None):
 	""" Downloads an executable from the given [download_url],
 		puts it in the current directory and renames it to [filename].
 		If the download is a zip or tar file it uses the first executable found in the archive.
+		If [sha256] is given the download is only used if its hash matches.
 	"""
 	# check if already exists
 	if isfile(filename):
@@ -287,94 +1261,382 @@ def downloadTool(download_url, filename):
 	print('Downloading', basename(download_url))
 	print(' ', 'from', download_url)
 	type = splitext(download_url)[1]
-	with urlopen(download_url, context=ssl._create_unverified_context()) as url: data = url.read()
+	if type not in ['.zip', '.tar', '.gz', '.exe', '']:
+		raise Exception('The download link does not point towards a zip archive, tar archive or executable.')
+	archive = filename + '.download'
+	downloadFile(download_url, archive, sha256)
 	
 	# zip archive
 	if type == '.zip':
-		with ZipFile(BytesIO(data)) as zip:
-			file = next((file for file in zip.infolist() if splitext(file.filename)[1] == splitext(filename)[1]), None)
+		from zipfile import ZipFile
+		with ZipFile(archive) as zip:
+			files = [file for file in zip.infolist() if not file.is_dir() and splitext(file.filename)[1] == splitext(filename)[1]]
+			file = next((file for file in files if basename(file.filename) == filename), files[0] if files else None)
 			if not file: raise Exception('The downloaded zip archive does not contain a suitable executable.')
 			print('Extracting', basename(file.filename))
-			zip.extract(file)
-			rename(basename(file.filename), filename)
+			with zip.open(file) as src, open(filename + '.part', 'wb') as dst: copyfileobj(src, dst)
+		remove(archive)
 	
 	# tar archive
 	elif type in ['.tar', '.gz']:
-		with TarFile(fileobj=BytesIO(data)) as tar:
-			file = next((file for file in tar.getmembers() if splitext(file.name)[1] == splitext(filename)[1]), None)
+		from tarfile import open as TarFile
+		with TarFile(archive) as tar:
+			files = [file for file in tar.getmembers() if file.isfile() and splitext(file.name)[1] == splitext(filename)[1]]
+			file = next((file for file in files if basename(file.name) == filename), files[0] if files else None)
 			if not file: raise Exception('The downloaded tar archive does not contain a suitable executable.')
 			print('Extracting', basename(file.name))
-			tar.extract(file)
-			rename(basename(file.name), filename)
+			with tar.extractfile(file) as src, open(filename + '.part', 'wb') as dst: copyfileobj(src, dst)
+		remove(archive)
 	
 	# executable
-	elif type in ['.exe', '']:
-		with open(filename, 'wb') as file:
-			file.write(data)
-	
-	# not supported
-	else: raise Exception('The download link does not point towards a zip archive, tar archive or executable.')
+	else: rename(archive, filename + '.part')
 	
 	# make executable
-	chmod(filename, stat(filename).st_mode | S_IXUSR | S_IXGRP | S_IXOTH)
+	chmod(filename + '.part', stat(filename + '.part').st_mode | S_IXUSR | S_IXGRP | S_IXOTH)
+	replace(filename + '.part', filename)
 	
 	# success
 	print('Downloaded', filename)
 	print()
 
-def extractGame(game_file, dstool, ctrtool):
-	""" Extracts the given [game_file]. Supports .cia and .3ds files. """
+def toolCacheDir():
+	""" Returns the default directory of the tool cache shared by all working directories of the current user. """
+	if os_name == 'nt': root = environ.get('LOCALAPPDATA') or join(expanduser('~'), 'AppData', 'Local')
+	else: root = environ.get('XDG_CACHE_HOME') or join(expanduser('~'), '.cache')
+	return join(root, 'GamePatcher', 'Tools')
+
+@contextmanager
+def fileLock(filename):
+	""" Holds an exclusive lock on [filename] while the context is active.
+		Blocks until other processes have released the lock.
+	"""
+	with open(filename, 'a+b') as file:
+		if os_name == 'nt':
+			import msvcrt
+			file.seek(0)
+			while True:
+				try: msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1); break
+				except OSError: pass # still locked after 10 attempts, try again
+			try: yield
+			finally:
+				file.seek(0)
+				msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+		else:
+			import fcntl
+			fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+			try: yield
+			finally: fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+def cachedTool(tool, download_url, opSys, cache_dir, sha256 = None):
+	""" Returns the path to the executable of [tool] in the tool cache [cache_dir].
+		The tools are cached by name, version, platform and the hash of the download,
+		or the hash of the [download_url] if no [sha256] hash is pinned.
+		Downloads the tool if it is not cached yet while holding a lock on the cache entry.
+	"""
+	key = sha256.lower() if sha256 else hashlib.sha256(download_url.encode()).hexdigest()
+	tool_dir = join(cache_dir, tool, '%s-%s-%s' % (TOOLS[tool]['version'], opSys, key[:16]))
+	makedirs(tool_dir, exist_ok=True)
+	with fileLock(tool_dir + '.lock'):
+		downloadTool(download_url, join(tool_dir, TOOLS[tool][opSys]['exe']), sha256)
+	return join(tool_dir, TOOLS[tool][opSys]['exe'])
+
+@contextmanager
+def resultIndex(cache_dir):
+	""" Yields the index of the result cache [cache_dir] while holding its lock and writes it back afterwards.
+		The index contains the cached results by key with their file, size and time of last use
+		and the hashes of the game files by path with their size and modification time.
+	"""
+	makedirs(cache_dir, exist_ok=True)
+	with fileLock(join(cache_dir, 'Index.lock')):
+		try:
+			with open(join(cache_dir, 'Index.json'), 'r') as file: index = json.load(file)
+		except (OSError, ValueError): index = dict()
+		index.setdefault('results', dict())
+		index.setdefault('hashes', dict())
+		yield index
+		index['hashes'] = {path: entry for path, entry in index['hashes'].items() if isfile(path)}
+		with open(join(cache_dir, 'Index.json.part'), 'w') as file: json.dump(index, file, indent=2)
+		replace(join(cache_dir, 'Index.json.part'), join(cache_dir, 'Index.json'))
+
+def cachedHash(cache_dir, filename):
+	""" Returns the hash of [filename] using the hash stored in the result cache [cache_dir]
+		if the size and modification time of the file have not changed.
+	"""
+	path, size, mtime = abspath(filename), getsize(filename), stat(filename).st_mtime_ns
+	with resultIndex(cache_dir) as index: entry = index['hashes'].get(path)
+	if entry and entry['size'] == size and entry['mtime'] == mtime: return entry['hash']
+	hash = hashFile(filename)
+	with resultIndex(cache_dir) as index: index['hashes'][path] = {'size': size, 'mtime': mtime, 'hash': hash}
+	return hash
+
+def resultKey(cache_dir, patch_file, game_file, version, names, tools, options):
+	""" Returns the key of the game rebuilt from [game_file] with the patch file or chain [patch_file] and [version].
+		The key also covers the [names] of the patches, the versions and download links of the [tools],
+		the [options] that change the result and the version of Game Patcher.
+	"""
+	key = {
+		'game': cachedHash(cache_dir, game_file),
+		'type': splitext(game_file)[1].lower(),
+		'patches': [hashFile(file) for file in chainFiles(patch_file)],
+		'version': version,
+		'names': names,
+		'tools': {tool: [TOOLS[tool]['version'], url] for tool, url in tools.items()},
+		'options': options,
+		'patcher': VERSION,
+	}
+	return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def fetchResult(cache_dir, key, output):
+	""" Puts the result with [key] from the result cache [cache_dir] at [output].
+		The result is hardlinked if possible. Returns whether the result was cached.
+	"""
+	with resultIndex(cache_dir) as index:
+		entry = index['results'].get(key)
+		cached = join(cache_dir, entry['file']) if entry else None
+		if not entry or not isfile(cached) or getsize(cached) != entry['size']:
+			index['results'].pop(key, None)
+			return False
+		if not isfile(output) or not samefile(cached, output): # replacing a hardlink with the same file does nothing
+			makedirs(split(abspath(output))[0], exist_ok=True)
+			if lexists(output + '.part'): remove(output + '.part')
+			linkFile(cached, output + '.part', ['hardlink', 'reflink', 'copy'])
+			replace(output + '.part', output)
+		entry['used'] = time()
+	return True
+
+def storeResult(cache_dir, key, output, max_size):
+	""" Adds the rebuilt game [output] to the result cache [cache_dir] with [key], hardlinked if possible.
+		Removes the least recently used results until the cache holds at most [max_size] bytes.
+		Games larger than [max_size] are not cached.
+	"""
+	size = getsize(output)
+	if size > max_size:
+		print('Skip the result cache,', output, 'is larger than', formatSize(max_size))
+		print()
+		return True
+	with resultIndex(cache_dir) as index:
+		file = key + splitext(output)[1].lower()
+		if lexists(join(cache_dir, file + '.part')): remove(join(cache_dir, file + '.part'))
+		linkFile(output, join(cache_dir, file + '.part'), ['hardlink', 'reflink', 'copy'])
+		replace(join(cache_dir, file + '.part'), join(cache_dir, file))
+		index['results'][key] = {'file': file, 'size': size, 'used': time()}
+		total = sum(entry['size'] for entry in index['results'].values())
+		for old in sorted(index['results'], key=lambda key: index['results'][key]['used']):
+			if total <= max_size: break
+			total -= index['results'][old]['size']
+			if isfile(join(cache_dir, index['results'][old]['file'])): remove(join(cache_dir, index['results'][old]['file']))
+			del index['results'][old]
+	print('Cached', output)
+	print()
+	return True
+
+def runConcurrently(commands, cwd = None):
+	""" Runs all [commands] at the same time and waits until all of them have finished.
+		[commands] maps a name to the argument list of a tool. Prints the name of each command.
+		Raises an exception naming every command that failed.
+	"""
+	for name in commands: print(' ', name)
+	procs = TOOL_RUNNER.run(commands, cwd=cwd)
+	errors = ['%s: %s exited with code %d' % (name, basename(proc.args[0]), proc.returncode) for name, proc in procs.items() if proc.returncode != 0]
+	if errors: raise Exception('\n'.join(errors))
+
+def formatSize(size):
+	""" Returns the given [size] in bytes as a readable string. """
+	return '%.1f MiB' % (size / 2**20)
+
+def diskUsage(paths):
+	""" Returns the disk space used by the files and directories in [paths]. Files with multiple links are counted once. """
+	seen = set()
+	total = 0
+	def add(path):
+		nonlocal total
+		try:
+			if isdir(path):
+				for name in listdir(path): add(join(path, name))
+				return
+			info = stat(path)
+		except OSError: return
+		if (info.st_dev, info.st_ino) in seen: return
+		seen.add((info.st_dev, info.st_ino))
+		total += getattr(info, 'st_blocks', 0) * 512 or info.st_size
+	for path in paths: add(path)
+	return total
+
+def checkFreeSpace(dir, needed, step):
+	""" Raises an exception if the disk containing [dir] has less than [needed] bytes available for [step]. """
+	free = disk_usage(dir).free
+	if needed > free:
+		raise Exception('Not enough disk space for %s: about %s needed, %s available in %s' % (step, formatSize(needed), formatSize(free), abspath(dir)))
+
+def hashFile(filename, chunk_size = 2**24):
+	""" Returns the BLAKE2b hash of [filename]. Reads the file in large chunks into a single buffer. """
+	hash = hashlib.blake2b(digest_size=20)
+	buffer = bytearray(chunk_size)
+	with open(filename, 'rb', buffering=0) as file:
+		while True:
+			size = file.readinto(buffer)
+			if not size: break
+			hash.update(memoryview(buffer)[:size])
+	return hash.hexdigest()
+
+def extractionTools():
+	""" Returns the versions of the tools that determine the result of extractGame. """
+	return {tool: TOOLS[tool]['version'] for tool in ['3dstool', 'ctrtool']}
+
+def readManifest(game_file, game_dir):
+	""" Returns the manifest of the extracted [game_file] in [game_dir].
+		Returns None if there is no manifest or the extraction does not match the game file, the tools or the manifest.
+		The game file is only hashed if its size or modification time has changed.
+	"""
 	try:
-		# check if already exists
-		game_dir = escapeName(game_file)
-		if isdir(game_dir):
+		with open(join(game_dir, 'Manifest.json'), 'r') as file: manifest = json.load(file)
+		source = manifest['source']
+		if manifest['tools'] != extractionTools(): return None
+		if getsize(game_file) != source['size']: return None
+		if stat(game_file).st_mtime_ns != source['mtime']:
+			if hashFile(game_file) != source['hash']: return None
+			source['mtime'] = stat(game_file).st_mtime_ns
+			writeManifest(game_dir, source)
+		for artifact, size in manifest['artifacts'].items():
+			if not isfile(join(game_dir, artifact)) or getsize(join(game_dir, artifact)) != size: return None
+		return manifest
+	except (OSError, ValueError, KeyError, TypeError): return None
+
+def writeManifest(game_dir, source):
+	""" Writes the manifest of the extraction in [game_dir] containing the [source] game file,
+		the tool versions and the size of every extracted file.
+	"""
+	artifacts = dict()
+	def collect(dir):
+		for name in listdir(join(game_dir, dir)):
+			if isdir(join(game_dir, dir, name)): collect(join(dir, name))
+			elif join(dir, name) != 'Manifest.json': artifacts[join(dir, name).replace('\\', '/')] = getsize(join(game_dir, dir, name))
+	collect('')
+	with open(join(game_dir, 'Manifest.json.part'), 'w') as file:
+		json.dump({'source': source, 'tools': extractionTools(), 'artifacts': artifacts}, file, indent=2)
+	replace(join(game_dir, 'Manifest.json.part'), join(game_dir, 'Manifest.json'))
+
+def romfsPath(name, patches):
+	""" Returns the path of the file in the RomFS that the patch [name] is applied to or None if it is not a file-level patch.
+		A file-level patch is named like the patch for DecryptedRomFS.bin in [patches] without its extension
+		followed by the path of the file and the extension, e.g. RomFS/font/cbf_std.bcfnt.xdelta.
+	"""
+	for patch, (orig, _) in patches.items():
+		folder, ext = splitext(patch)
+		if orig == 'DecryptedRomFS.bin' and name.startswith(folder + '/') and name.endswith(ext) and len(name) > len(folder) + 1 + len(ext):
+			return name[len(folder)+1:len(name)-len(ext)]
+	return None
+
+def filePatches(names, patches):
+	""" Returns [patches] together with the file-level patches of the RomFS in [names],
+		each applied to the file extracted to ExtractedRomFS and writing the file in CustomRomFS.
+	"""
+	patches = dict(patches)
+	for name in names:
+		path = romfsPath(name, patches)
+		if path is not None and name not in patches: patches[name] = (join('ExtractedRomFS', *path.split('/')), join('CustomRomFS', *path.split('/')))
+	return patches
+
+def requiredParts(patch_file, patches):
+	""" Reads the names of the patches in [patch_file] and returns the parts of the game they target
+		as defined in [patches]. The parts are partition numbers, 'exefs' if ExtractedExeFS is needed
+		and 'romfs' if DecryptedRomFS.bin is needed.
+	"""
+	from zipfile import ZipFile
+	parts = set()
+	with ZipFile(patch_file, 'r') as file:
+		patches = filePatches(file.namelist(), patches)
+		for info in file.infolist():
+			if info.is_dir() or info.filename not in patches: continue
+			orig = patches[info.filename][0]
+			if split(orig)[0] == 'ExtractedExeFS': parts |= {0, 'exefs'}
+			elif orig.startswith('ExtractedRomFS') or orig == 'DecryptedRomFS.bin': parts |= {PARTITIONS['DecryptedRomFS.bin'], 'romfs'}
+			elif orig in PARTITIONS: parts.add(PARTITIONS[orig])
+	return parts
+
+def extractGame(game_file, dstool, ctrtool, parts = None, workdir = '.'):
+	""" Extracts the given [game_file] into a folder in [workdir]. Supports .cia and .3ds files.
+		Only splits the partitions and extracts the ExeFS if they are contained in [parts].
+		All other partitions are kept as DecryptedPartitionX.bin. If [parts] is None everything is extracted.
+		Partition 0 is split without extracting DecryptedRomFS.bin unless [parts] contains 'romfs',
+		DecryptedPartition0.bin is then kept to copy the RomFS from when rebuilding.
+		Parts that are missing in an existing extraction are extracted additionally.
+	"""
+	try:
+		# check if already exists and is still valid
+		game_dir = join(workdir, escapeName(game_file))
+		romfs = parts is None or 'romfs' in parts
+		manifest = readManifest(game_file, game_dir) if isdir(game_dir) else None
+		if isdir(game_dir) and manifest is None:
+			print('Discard', game_dir)
+			rmtree(game_dir)
+		def missingParts():
+			partitions = [int(f[18:-4]) for f in listdir(game_dir) if f.startswith('DecryptedPartition')]
+			partitions = [id for id in partitions if parts is None or id in parts]
+			if 0 in partitions and not romfs and isfile(join(game_dir, 'HeaderNCCH0.bin')): partitions.remove(0) # split without the RomFS
+			exefs = (parts is None or 'exefs' in parts) and not isdir(join(game_dir, 'ExtractedExeFS')) and (0 in partitions or isfile(join(game_dir, 'DecryptedExeFS.bin')))
+			return partitions, exefs
+		if isdir(game_dir) and missingParts() == ([], False):
 			print('Found', game_dir)
+			print()
 			return True
 		print('Extract', game_file)
 		mode = splitext(game_file)[1][1:].lower()
 		
+		# hash the game file while extracting, the manifest is only written again when the extraction is complete
+		hasher = ThreadPoolExecutor(max_workers=1)
+		source = hasher.submit(lambda: manifest['source'] if manifest else {'size': getsize(game_file), 'mtime': stat(game_file).st_mtime_ns, 'hash': hashFile(game_file)})
+		hasher.shutdown(wait=False)
+		if manifest: remove(join(game_dir, 'Manifest.json'))
+		
 		# step 1: cia / 3ds -> DecryptedPartitionX.bin
-		print('Extracting Step 1/3')
-		makedirs(game_dir, exist_ok=True)
-		if mode == 'cia':
-			proc = run('"%s" -x --content="%s" "%s"' % (abspath(ctrtool), abspath(join(game_dir, 'Decrypted')), abspath(game_file)), shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-			partitions = list()
-			for decrypted_file in [f for f in listdir(game_dir) if f.startswith('Decrypted')]:
-				id = int(decrypted_file[10:14])
-				rename(join(game_dir, decrypted_file), join(game_dir, 'DecryptedPartition%d.bin' % id))
-				partitions.append(id)
-		elif mode == '3ds':
-			proc = run('"%s" -xtf 3ds "%s" --header HeaderNCCH.bin -0 DecryptedPartition0.bin -1 DecryptedPartition1.bin -2 DecryptedPartition2.bin -6 DecryptedPartition6.bin -7 DecryptedPartition7.bin' % (abspath(dstool), abspath(game_file)), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-			partitions = [int(f[18]) for f in listdir(game_dir) if f.startswith('DecryptedPartition')]
+		if not isdir(game_dir):
+			printStep('Extracting Step 1/3')
+			checkFreeSpace(split(abspath(game_dir))[0], getsize(game_file), 'extracting %s' % game_file)
+			makedirs(game_dir, exist_ok=True)
+			try: splitGame(game_file, game_dir)
+			except (NotImplementedError, ValueError) as e: # split with the external tools instead
+				print(' ', str(e).strip())
+				if mode == 'cia':
+					proc = runTool([abspath(ctrtool), '-x', '--content=%s' % abspath(join(game_dir, 'Decrypted')), abspath(game_file)])
+					if proc.returncode != 0: raise Exception('ctrtool exited with code %d' % proc.returncode)
+					for decrypted_file in [f for f in listdir(game_dir) if f.startswith('Decrypted')]:
+						id = int(decrypted_file[10:14])
+						rename(join(game_dir, decrypted_file), join(game_dir, 'DecryptedPartition%d.bin' % id))
+				elif mode == '3ds':
+					proc = runTool([abspath(dstool), '-xtf', '3ds', abspath(game_file), '--header', 'HeaderNCCH.bin'] + \
+						[argument for id in [0, 1, 2, 6, 7] for argument in ['-%d' % id, 'DecryptedPartition%d.bin' % id]], cwd=game_dir)
+					if proc.returncode != 0: raise Exception('3dstool exited with code %d' % proc.returncode)
+			for id in [int(f[18:-4]) for f in listdir(game_dir) if f.startswith('DecryptedPartition')]:
+				if id not in [0, 1, 2]: remove(join(game_dir, 'DecryptedPartition%d.bin' % id))
 		
 		# step 2: DecryptedPartitionX.bin -> HeaderNCCHX.bin, DecryptedXXX.bin, ...
-		print('Extracting Step 2/3')
-		if 0 in partitions:
-			print(' ', 'Partition0')
-			proc = run('"%s" -xtf cxi DecryptedPartition0.bin --header HeaderNCCH0.bin --exh DecryptedExHeader.bin --exefs DecryptedExeFS.bin --romfs DecryptedRomFS.bin --logo LogoLZ.bin --plain PlainRGN.bin' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		if 1 in partitions:
-			print(' ', 'Partition1')
-			proc = run('"%s" -xtf cfa DecryptedPartition1.bin --header HeaderNCCH1.bin --romfs DecryptedManual.bin' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		if 2 in partitions:
-			print(' ', 'Partition2')
-			proc = run('"%s" -xtf cfa DecryptedPartition2.bin --header HeaderNCCH2.bin --romfs DecryptedDownloadPlay.bin' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		for id in partitions: remove(join(game_dir, 'DecryptedPartition%d.bin' % id))
+		partitions, exefs = missingParts()
+		if partitions:
+			printStep('Extracting Step 2/3')
+			checkFreeSpace(game_dir, sum(getsize(join(game_dir, 'DecryptedPartition%d.bin' % id)) for id in partitions if id != 0 or romfs), 'extracting %s' % game_file)
+			commands = dict()
+			if 0 in partitions and not romfs:
+				print(' ', 'Partition0')
+				try: splitNCCH(join(game_dir, 'DecryptedPartition0.bin'), game_dir)
+				except ValueError as e: # split with 3dstool instead
+					print(' ', str(e).strip())
+					romfs = True
+			if 0 in partitions and romfs: commands['Partition0'] = [abspath(dstool), '-xtf', 'cxi', 'DecryptedPartition0.bin', '--header', 'HeaderNCCH0.bin', '--exh', 'DecryptedExHeader.bin', '--exefs', 'DecryptedExeFS.bin', '--romfs', 'DecryptedRomFS.bin', '--logo', 'LogoLZ.bin', '--plain', 'PlainRGN.bin']
+			if 1 in partitions: commands['Partition1'] = [abspath(dstool), '-xtf', 'cfa', 'DecryptedPartition1.bin', '--header', 'HeaderNCCH1.bin', '--romfs', 'DecryptedManual.bin']
+			if 2 in partitions: commands['Partition2'] = [abspath(dstool), '-xtf', 'cfa', 'DecryptedPartition2.bin', '--header', 'HeaderNCCH2.bin', '--romfs', 'DecryptedDownloadPlay.bin']
+			runConcurrently(commands, cwd=game_dir)
+			for id in partitions:
+				if id != 0 or romfs: remove(join(game_dir, 'DecryptedPartition%d.bin' % id))
 		
 		# step 3: DecryptedExeFS.bin -> ExtractedExeFS
-		print('Extracting Step 3/3')
-		if isfile(join(game_dir, 'DecryptedExeFS.bin')):
-			proc = run('"%s" -xtf exefs DecryptedExeFS.bin --exefs-dir ExtractedExeFS --header HeaderExeFS.bin' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-			exefs_dir = join(game_dir, 'ExtractedExeFS')
-			if isfile(join(exefs_dir, 'banner.bnr')): rename(join(exefs_dir, 'banner.bnr'), join(exefs_dir, 'banner.bin'))
-			if isfile(join(exefs_dir, 'icon.icn')):   rename(join(exefs_dir, 'icon.icn'),   join(exefs_dir, 'icon.bin'))
+		if exefs:
+			printStep('Extracting Step 3/3')
+			checkFreeSpace(game_dir, getsize(join(game_dir, 'DecryptedExeFS.bin')), 'extracting %s' % game_file)
+			unpackExeFS(join(game_dir, 'DecryptedExeFS.bin'), join(game_dir, 'ExtractedExeFS'), join(game_dir, 'HeaderExeFS.bin'))
 		
 		# success
+		writeManifest(game_dir, source.result())
 		print('Extracted to', game_dir)
 		print()
 		return True
@@ -383,100 +1645,256 @@ def extractGame(game_file, dstool, ctrtool):
 		print(str(e).strip())
 		print('ERROR: Extracting Failed')
 		print()
+		rmtree(game_dir, ignore_errors=True) # do not reuse an incomplete extraction
 		return False
 
-def prepareGame(patch_file, game_file):
-	""" Copies all files from the original game to the patch game folder.
+def reflink(src, dst):
+	""" Creates [dst] as a copy-on-write clone of [src].
+		Raises an OSError if the platform or the file system does not support it.
+	"""
+	if sys.platform.startswith('linux'):
+		import fcntl
+		try:
+			with open(src, 'rb') as s, open(dst, 'wb') as d:
+				fcntl.ioctl(d.fileno(), 0x40049409, s.fileno()) # FICLONE
+		except OSError:
+			if isfile(dst): remove(dst)
+			raise
+	elif sys.platform == 'darwin':
+		import ctypes
+		libc = ctypes.CDLL(None, use_errno=True)
+		if libc.clonefile(src.encode(), dst.encode(), 0) != 0:
+			raise OSError(ctypes.get_errno(), 'clonefile failed')
+	else: raise OSError('Reflinks are not supported on this platform.')
+
+def linkFile(src, dst, modes):
+	""" Creates [dst] with the content of [src] using the first of the given [modes] that works.
+		Supported modes are 'reflink', 'hardlink', 'symlink' and 'copy'. The last mode must not fail.
+		Returns the mode that was used.
+	"""
+	for mode in modes[:-1]:
+		try:
+			if mode == 'reflink': reflink(src, dst)
+			elif mode == 'hardlink': link(src, dst)
+			elif mode == 'symlink': symlink(abspath(src), dst)
+			return mode
+		except OSError: pass
+	copyfile(src, dst)
+	return 'copy'
+
+def prepareGame(patch_file, game_file, workspace = 'link', workdir = '.'):
+	""" Copies all files from the original game to the patch game folder. Both folders are in [workdir].
 		Creates CustomXXX files for all XXX files.
+		If [workspace] is 'link' the files are reflinked, hardlinked or symlinked instead of copied.
+		This is safe since no file in the patch game folder is modified in place,
+		every file that is written is created anew and replaces the existing file.
+		If the patch game folder already exists only files that are missing are added,
+		unless it was created from a different extraction of the game.
 	"""
-	# check if already exists
-	orig_dir = escapeName(game_file)
-	game_dir = escapeName(createName(game_file, patch_file))
-	if isdir(game_dir):
-		print('Found', game_dir)
+	try:
+		# check if already exists
+		orig_dir = join(workdir, escapeName(game_file))
+		game_dir = join(workdir, escapeName(createName(game_file, patch_file)))
+		def source(dir):
+			try:
+				with open(join(dir, 'Manifest.json'), 'r') as file: return json.load(file)['source']['hash']
+			except (OSError, ValueError, KeyError, TypeError): return None
+		found = isdir(game_dir)
+		if found and source(game_dir) != source(orig_dir):
+			print('Discard', game_dir)
+			rmtree(game_dir)
+			found = False
+		if found: print('Found', game_dir)
+		else: print('Copy', orig_dir)
+		
+		# the originals are only read, the custom files are replaced when they are written
+		orig_modes = ['hardlink', 'reflink', 'symlink', 'copy'] if workspace == 'link' else ['copy']
+		custom_modes = ['reflink', 'hardlink', 'symlink', 'copy'] if workspace == 'link' else ['copy']
+		if workspace == 'copy' and not found: # the originals and most of them again as custom files
+			checkFreeSpace(split(abspath(game_dir))[0], 2 * diskUsage([orig_dir]), 'copying %s' % orig_dir)
+		
+		# remove partitions that have been split since the patch game folder was created
+		if found:
+			for file in [f for f in listdir(game_dir) if f.startswith('DecryptedPartition')]:
+				if not isfile(join(orig_dir, file)): remove(join(game_dir, file))
+		
+		# copy folder
+		def lt(src, dst, modes):
+			makedirs(dst, exist_ok=True)
+			for name in listdir(src):
+				if isdir(join(src, name)): lt(join(src, name), join(dst, name), modes)
+				elif not lexists(join(dst, name)): linkFile(join(src, name), join(dst, name), modes)
+		lt(orig_dir, game_dir, orig_modes)
+		
+		# copy files
+		def ct(x, y):
+			if isdir(join(orig_dir, x)): lt(join(orig_dir, x), join(game_dir, y), custom_modes)
+		def cf(x, y):
+			if isfile(join(orig_dir, x)) and not lexists(join(game_dir, y)): linkFile(join(orig_dir, x), join(game_dir, y), custom_modes)
+		ct('ExtractedExeFS', 'CustomExeFS')
+		cf('HeaderExeFS.bin', 'CustomHeaderExeFS.bin')
+		cf('DecryptedExeFS.bin', 'CustomExeFS.bin')
+		cf('DecryptedExHeader.bin', 'CustomExHeader.bin')
+		cf('DecryptedRomFS.bin', 'CustomRomFS.bin')
+		cf('HeaderNCCH0.bin', 'CustomHeaderNCCH0.bin')
+		cf('LogoLZ.bin', 'CustomLogoLZ.bin')
+		cf('PlainRGN.bin', 'CustomPlainRGN.bin')
+		cf('DecryptedManual.bin', 'CustomManual.bin')
+		cf('HeaderNCCH1.bin', 'CustomHeaderNCCH1.bin')
+		cf('DecryptedDownloadPlay.bin', 'CustomDownloadPlay.bin')
+		cf('HeaderNCCH2.bin', 'CustomHeaderNCCH2.bin')
+		
+		# success
+		if not found: print('Copied to', game_dir)
+		print()
 		return True
-	print('Copy', orig_dir)
-	
-	# copy folder
-	copytree(orig_dir, game_dir)
-	
-	# copy files
-	def ct(x, y):
-		if isdir(join(game_dir, x)): copytree(join(game_dir, x), join(game_dir, y))
-	def cf(x, y):
-		if isfile(join(game_dir, x)): copyfile(join(game_dir, x), join(game_dir, y))
-	ct('ExtractedExeFS', 'CustomExeFS')
-	cf('HeaderExeFS.bin', 'CustomHeaderExeFS.bin')
-	cf('DecryptedExeFS.bin', 'CustomExeFS.bin')
-	cf('DecryptedExHeader.bin', 'CustomExHeader.bin')
-	cf('DecryptedRomFS.bin', 'CustomRomFS.bin')
-	cf('HeaderNCCH0.bin', 'CustomHeaderNCCH0.bin')
-	cf('LogoLZ.bin', 'CustomLogoLZ.bin')
-	cf('PlainRGN.bin', 'CustomPlainRGN.bin')
-	cf('DecryptedManual.bin', 'CustomManual.bin')
-	cf('HeaderNCCH1.bin', 'CustomHeaderNCCH1.bin')
-	cf('DecryptedDownloadPlay.bin', 'CustomDownloadPlay.bin')
-	cf('HeaderNCCH2.bin', 'CustomHeaderNCCH2.bin')
-	
-	# success
-	print('Copied to', game_dir)
-	print()
-	return True
+		
+	except Exception as e:
+		print(str(e).strip())
+		print('ERROR: Copying Failed')
+		print()
+		return False
+
+def fingerprintFiles(dir, files, previous = None, known = None):
+	""" Returns the size, modification time and hash of the given [files] in [dir].
+		Uses the hashes in [known] for the files it contains and reuses the hashes of the [previous] fingerprint
+		for files whose size and modification time have not changed.
+	"""
+	previous = previous or dict()
+	known = known or dict()
+	fingerprint = dict()
+	for file in files:
+		info = stat(join(dir, file))
+		if file in known: fingerprint[file] = [info.st_size, info.st_mtime_ns, known[file]]
+		elif previous.get(file, [None, None])[:2] == [info.st_size, info.st_mtime_ns]: fingerprint[file] = previous[file]
+		else: fingerprint[file] = [info.st_size, info.st_mtime_ns, hashFile(join(dir, file))]
+	return fingerprint
 
-def rebuildGame(patch_file, game_file, version, dstool, makerom):
-	""" Rebuilds the game file defined by the given [game_file] and [patch_file].
+def rebuildGame(patch_file, game_file, version, dstool, makerom, low_disk = False, workdir = '.', output = None):
+	""" Rebuilds the game file defined by the given [game_file] and [patch_file] from the patch game folder in [workdir].
+		The game file is written to [output], which defaults to the name created by createName next to [game_file],
+		and only replaces an existing file when it is complete.
 		Sets the version of the cia file to [version].
+		Skips every step whose inputs have not changed since the last rebuild and whose output still exists.
+		If partition 0 was split without its RomFS it is rebuilt by rebuildNCCH instead of 3dstool.
+		The fingerprints of the inputs are stored in Rebuild.json in the patch game folder.
+		If [low_disk] is True every file in the patch game folder is deleted as soon as it is no longer needed.
 	"""
 	try:
 		# check if exists
-		rebuilt_game_file = createName(game_file, patch_file)
-		game_dir = escapeName(rebuilt_game_file)
-		if isfile(rebuilt_game_file): remove(rebuilt_game_file)
+		rebuilt_game_file = output if output is not None else createName(game_file, patch_file)
+		game_dir = join(workdir, escapeName(createName(game_file, patch_file)))
 		print('Rebuild', game_dir)
 		mode = splitext(game_file)[1][1:].lower()
 		
+		# load the fingerprints of the last rebuild
+		try:
+			with open(join(game_dir, 'Rebuild.json'), 'r') as file: steps = json.load(file)
+		except (OSError, ValueError): steps = dict()
+		# the outputs of the steps are not hashed, their hash is derived from the hashes of the inputs of their step
+		built = dict()
+		def derive(inputs, output, params):
+			built[output] = hashlib.sha256(json.dumps([{f: v[2] for f, v in inputs.items()}, params], sort_keys=True).encode()).hexdigest()
+		def unchanged(step, inputs, output, params = None):
+			last = steps.get(step, dict())
+			inputs = fingerprintFiles(game_dir, inputs, last.get('inputs'), {f: built[join(game_dir, f)] for f in inputs if join(game_dir, f) in built})
+			same_inputs = {f: v[2] for f, v in inputs.items()} == {f: v[2] for f, v in last.get('inputs', dict()).items()}
+			same_output = isfile(output) and [getsize(output), stat(output).st_mtime_ns] == last.get('output')
+			skip = same_inputs and same_output and params == last.get('params')
+			if skip: derive(inputs, output, params)
+			return skip, inputs
+		def record(step, inputs, output, params = None):
+			derive(inputs, output, params)
+			steps[step] = {'inputs': inputs, 'params': params, 'output': [getsize(output), stat(output).st_mtime_ns]}
+			with open(join(game_dir, 'Rebuild.json.part'), 'w') as file: json.dump(steps, file, indent=2)
+			replace(join(game_dir, 'Rebuild.json.part'), join(game_dir, 'Rebuild.json'))
+		def free(*names):
+			for name in names:
+				if isdir(join(game_dir, name)): rmtree(join(game_dir, name))
+				elif lexists(join(game_dir, name)): remove(join(game_dir, name))
+		
+		# only the custom files and the partitions that were not split are needed
+		if low_disk:
+			free(*[f for f in listdir(game_dir) if not f.startswith('Custom') and not f.startswith('DecryptedPartition') and f not in ['HeaderNCCH.bin', 'Rebuild.json']])
+		
 		# step 1: CustomExeFS -> CustomExeFS.bin
-		print('Rebuilding Step 1/3')
+		printStep('Rebuilding Step 1/3')
 		exefs_dir = join(game_dir, 'CustomExeFS')
 		if isdir(exefs_dir) and isfile(join(game_dir, 'CustomHeaderExeFS.bin')):
-			if isfile(join(exefs_dir, 'banner.bin')): rename(join(exefs_dir, 'banner.bin'), join(exefs_dir, 'banner.bnr'))
-			if isfile(join(exefs_dir, 'icon.bin')):   rename(join(exefs_dir, 'icon.bin'),   join(exefs_dir, 'icon.icn'))
-			proc = run('"%s" -ctf exefs CustomExeFS.bin --exefs-dir CustomExeFS --header CustomHeaderExeFS.bin' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-			if isfile(join(exefs_dir, 'banner.bnr')): rename(join(exefs_dir, 'banner.bnr'), join(exefs_dir, 'banner.bin'))
-			if isfile(join(exefs_dir, 'icon.icn')):   rename(join(exefs_dir, 'icon.icn'),   join(exefs_dir, 'icon.bin'))
+			inputs = ['CustomHeaderExeFS.bin'] + [join('CustomExeFS', f) for f in sorted(listdir(exefs_dir))]
+			skip, inputs = unchanged('ExeFS', inputs, join(game_dir, 'CustomExeFS.bin'))
+			if skip: print(' ', 'ExeFS unchanged')
+			else:
+				checkFreeSpace(game_dir, sum(getsize(join(game_dir, f)) for f in inputs), 'rebuilding %s' % rebuilt_game_file)
+				packExeFS(exefs_dir, join(game_dir, 'CustomHeaderExeFS.bin'), join(game_dir, 'CustomExeFS.bin'))
+				record('ExeFS', inputs, join(game_dir, 'CustomExeFS.bin'))
+			if low_disk: free('CustomExeFS', 'CustomHeaderExeFS.bin')
 		
 		# step 2: CustomHeaderNCCHX.bin, CustomDecryptedXXX.bin, ... -> CustomPartitionX.bin
-		print('Rebuilding Step 2/3')
+		printStep('Rebuilding Step 2/3')
+		commands = dict()
+		rebuilds = dict()
+		inputs = dict()
 		if all(isfile(join(game_dir, f)) for f in ['CustomHeaderNCCH0.bin', 'CustomExHeader.bin', 'CustomExeFS.bin', 'CustomRomFS.bin']):
-			print(' ', 'Partition0')
-			arguments = ['--header CustomHeaderNCCH0.bin', '--exh CustomExHeader.bin', '--exefs CustomExeFS.bin', '--romfs CustomRomFS.bin']
-			if isfile(join(game_dir, 'CustomLogoLZ.bin')):   arguments.append('--logo CustomLogoLZ.bin')
-			if isfile(join(game_dir, 'CustomPlainRGN.bin')): arguments.append('--plain CustomPlainRGN.bin')
-			proc = run('"%s" -ctf cxi CustomPartition0.bin %s' % (abspath(dstool), ' '.join(arguments)), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
+			arguments = [('--header', 'CustomHeaderNCCH0.bin'), ('--exh', 'CustomExHeader.bin'), ('--exefs', 'CustomExeFS.bin'), ('--romfs', 'CustomRomFS.bin')]
+			if isfile(join(game_dir, 'CustomLogoLZ.bin')):   arguments.append(('--logo', 'CustomLogoLZ.bin'))
+			if isfile(join(game_dir, 'CustomPlainRGN.bin')): arguments.append(('--plain', 'CustomPlainRGN.bin'))
+			commands['Partition0'] = [abspath(dstool), '-ctf', 'cxi', 'CustomPartition0.bin'] + [argument for pair in arguments for argument in pair]
+			inputs['Partition0'] = [file for _, file in arguments]
+		elif all(isfile(join(game_dir, f)) for f in ['CustomHeaderNCCH0.bin', 'DecryptedPartition0.bin']): # split without the RomFS
+			files = {name: f for name, f in [('exh', 'CustomExHeader.bin'), ('logo', 'CustomLogoLZ.bin'), ('plain', 'CustomPlainRGN.bin'), ('exefs', 'CustomExeFS.bin')] if isfile(join(game_dir, f))}
+			rebuilds['Partition0'] = lambda: rebuildNCCH(join(game_dir, 'DecryptedPartition0.bin'), join(game_dir, 'CustomHeaderNCCH0.bin'), \
+				{name: join(game_dir, f) for name, f in files.items()}, join(game_dir, 'CustomPartition0.bin'))
+			inputs['Partition0'] = ['CustomHeaderNCCH0.bin'] + list(files.values()) + ['DecryptedPartition0.bin']
 		if all(isfile(join(game_dir, f)) for f in ['CustomHeaderNCCH1.bin', 'CustomManual.bin']):
-			print(' ', 'Partition1')
-			proc = run('"%s" -ctf cfa CustomPartition1.bin --header CustomHeaderNCCH1.bin --romfs CustomManual.bin' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
+			commands['Partition1'] = [abspath(dstool), '-ctf', 'cfa', 'CustomPartition1.bin', '--header', 'CustomHeaderNCCH1.bin', '--romfs', 'CustomManual.bin']
+			inputs['Partition1'] = ['CustomHeaderNCCH1.bin', 'CustomManual.bin']
 		if all(isfile(join(game_dir, f)) for f in ['CustomHeaderNCCH2.bin', 'CustomDownloadPlay.bin']):
-			print(' ', 'Partition2')
-			proc = run('"%s" -ctf cfa CustomPartition2.bin --header CustomHeaderNCCH2.bin --romfs CustomDownloadPlay.bin' % abspath(dstool), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
+			commands['Partition2'] = [abspath(dstool), '-ctf', 'cfa', 'CustomPartition2.bin', '--header', 'CustomHeaderNCCH2.bin', '--romfs', 'CustomDownloadPlay.bin']
+			inputs['Partition2'] = ['CustomHeaderNCCH2.bin', 'CustomDownloadPlay.bin']
+		for name in list(inputs):
+			skip, inputs[name] = unchanged(name, inputs[name], join(game_dir, 'Custom%s.bin' % name))
+			if skip:
+				print(' ', name, 'unchanged')
+				commands.pop(name, None)
+				rebuilds.pop(name, None)
+		checkFreeSpace(game_dir, sum(getsize(join(game_dir, f)) for name in [*commands, *rebuilds] for f in inputs[name]), 'rebuilding %s' % rebuilt_game_file)
+		runConcurrently(commands, cwd=game_dir)
+		for name, rebuild in rebuilds.items():
+			print(' ', name)
+			rebuild()
+		for name in [*commands, *rebuilds]: record(name, inputs[name], join(game_dir, 'Custom%s.bin' % name))
+		if low_disk:
+			for name in inputs: free(*inputs[name])
 		
 		# step 3: CustomPartitionX.bin -> cia / 3ds
-		print('Rebuilding Step 3/3')
-		if mode == 'cia':
-			print(' ', 'CIA', int2version(version))
-			contents = ['-content "%s":%s:%s' % (abspath(join(game_dir, f)), f[15], f[15]) for f in listdir(game_dir) if f.startswith('CustomPartition')]
-			proc = run('"%s" -f cia %s -ver %d -o "%s" -target p -ignoresign' % (abspath(makerom), ' '.join(contents), version, abspath(rebuilt_game_file)), shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		elif mode == '3ds':
-			contents = ['--header "%s"' % abspath(join(game_dir, 'HeaderNCCH.bin'))]
-			contents += ['-%s "%s"' % (f[15], abspath(join(game_dir, f))) for f in listdir(game_dir) if f.startswith('CustomPartition')]
-			proc = run('"%s" -ctf 3ds "%s" --header HeaderNCCH.bin %s' % (abspath(dstool), abspath(rebuilt_game_file), ' '.join(contents)), shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0: raise Exception(proc.stdout.decode(errors='replace'))
-		for file in [f for f in listdir(game_dir) if f.startswith('CustomPartition')]: remove(join(game_dir, file))
+		printStep('Rebuilding Step 3/3')
+		# partitions without any patched parts were not split and are used as they are
+		partitions = {int(f[18:-4]): f for f in listdir(game_dir) if f.startswith('DecryptedPartition')}
+		partitions.update({int(f[15:-4]): f for f in listdir(game_dir) if f.startswith('CustomPartition')})
+		inputs = [f for _, f in sorted(partitions.items())] + (['HeaderNCCH.bin'] if mode == '3ds' else [])
+		params = {'mode': mode, 'version': version if mode == 'cia' else None}
+		skip, inputs = unchanged('Game', inputs, rebuilt_game_file, params)
+		if skip: print(' ', 'Game unchanged')
+		else:
+			makedirs(split(abspath(rebuilt_game_file))[0], exist_ok=True)
+			checkFreeSpace(split(abspath(rebuilt_game_file))[0], sum(getsize(join(game_dir, f)) for f in inputs), 'rebuilding %s' % rebuilt_game_file)
+			temp = rebuilt_game_file + '.part' # the existing game file is only replaced when the new one is complete
+			try:
+				if mode == 'cia':
+					print(' ', 'CIA', int2version(version))
+					contents = [argument for id, f in sorted(partitions.items()) for argument in ['-content', '%s:%d:%d' % (abspath(join(game_dir, f)), id, id)]]
+					proc = runTool([abspath(makerom), '-f', 'cia'] + contents + ['-ver', str(version), '-o', abspath(temp), '-target', 'p', '-ignoresign'])
+					if proc.returncode != 0: raise Exception('makerom exited with code %d' % proc.returncode)
+				elif mode == '3ds':
+					contents = ['--header', abspath(join(game_dir, 'HeaderNCCH.bin'))]
+					contents += [argument for id, f in sorted(partitions.items()) for argument in ['-%d' % id, abspath(join(game_dir, f))]]
+					proc = runTool([abspath(dstool), '-ctf', '3ds', abspath(temp)] + contents)
+					if proc.returncode != 0: raise Exception('3dstool exited with code %d' % proc.returncode)
+				replace(temp, rebuilt_game_file)
+			finally:
+				if isfile(temp): remove(temp)
+			record('Game', inputs, rebuilt_game_file, params)
 		
 		# success
 		print('Rebuilt', rebuilt_game_file)
@@ -489,34 +1907,106 @@ def rebuildGame(patch_file, game_file, version, dstool, makerom):
 		print()
 		return False
 
-def applyPatches(patch_file, game_file, patches, xdelta, ignore_incompatible_patches = False):
-	""" Extracts the patches in [patch_file] and applies them to the extracted [game_file].
+def applyPatches(patch_file, game_file, patches, xdelta, ignore_incompatible_patches = False, jobs = 1, native_limit = 0, workdir = '.', game_dir = None, sources = None):
+	""" Applies the patches in [patch_file] to the extracted [game_file] in [workdir].
 		Applies the patches to the files as defined in [patches].
+		Applies patches up to [native_limit] bytes with the built-in decoder and all others with [xdelta].
+		Uses [xdelta] as fallback if the built-in decoder fails and [xdelta] is not None.
+		Applies up to [jobs] patches at the same time and prints a table with the result of each patch.
+		If [patch_file] is a chain of patch files they are applied in this order to the same patch game folder [game_dir]
+		and each patch uses the custom file as source if it is in [sources], the custom files written so far.
+		The file-level patches of the RomFS are applied to the files extracted from the RomFS, which is then rebuilt with the patched files.
 	"""
+	if not isinstance(patch_file, str):
+		game_dir = join(workdir, escapeName(createName(game_file, patch_file)))
+		sources = set()
+		return all(applyPatches(file, game_file, patches, xdelta, ignore_incompatible_patches, jobs, native_limit, workdir, game_dir, sources) for file in patch_file)
 	try:
-		game_dir = escapeName(createName(game_file, patch_file))
+		if game_dir is None: game_dir = join(workdir, escapeName(createName(game_file, patch_file)))
 		print('Apply', patch_file, '→', game_file)
 		
-		# extract patches
-		print('Extract', patch_file)
-		patch_dir = join(game_dir, 'Patches')
+		# list patches
+		from zipfile import ZipFile
 		with ZipFile(patch_file, 'r') as file:
-			file.extractall(patch_dir)
-		
-		# apply patches
-		for patch in listdir(patch_dir):
+			infos = {info.filename: info for info in file.infolist() if not info.is_dir()}
+		names = list(infos)
+		patches = filePatches(names, patches)
+		for patch in names:
 			if patch not in patches: raise Exception('Unknown patch', patch)
-			print('Apply', patch)
+		
+		# the file-level patches of the RomFS are applied to files extracted from the current RomFS
+		romfs = {patch: romfsPath(patch, patches) for patch in names if patches[patch][0].startswith('ExtractedRomFS')}
+		image = 'CustomRomFS.bin' if 'CustomRomFS.bin' in (sources or ()) else 'DecryptedRomFS.bin'
+		if romfs:
+			if any(patches[patch][0] == 'DecryptedRomFS.bin' for patch in names): raise Exception('The RomFS cannot be patched as a whole and by file at once', patch_file)
+			print('Extract RomFS files from', image)
+			extractRomFS(join(game_dir, image), list(romfs.values()), join(game_dir, 'ExtractedRomFS'))
+			for patch in romfs: makedirs(split(join(game_dir, patches[patch][1]))[0], exist_ok=True)
+		
+		# apply patches, largest sources first so the small patches overlap with them
+		# the patches are streamed from the zip file into the decoder without extracting them
+		def source(patch):
 			orig, custom = patches[patch]
-			proc = run('"%s" -f -d -s %s Patches/%s %s' % (abspath(xdelta), orig, patch, custom), cwd=game_dir, shell=True, stdout=PIPE, stderr=STDOUT)
-			if proc.returncode != 0:
-				if ignore_incompatible_patches:
-					print(proc.stdout.decode(errors='replace').strip())
-					print('WARNING: Failed to apply', patch)
-				else: raise Exception(proc.stdout.decode(errors='replace'))
-		
-		# clean up
-		rmtree(patch_dir)
+			return custom if custom in (sources or ()) else orig
+		def size(patch):
+			orig = join(game_dir, source(patch))
+			return getsize(orig) if isfile(orig) else 0
+		decoders = dict()
+		def native(patch):
+			orig, custom = source(patch), patches[patch][1]
+			temp = join(game_dir, custom + '.part')
+			try:
+				with ZipFile(patch_file, 'r') as file, file.open(patch) as member:
+					decodeVCDiff(member, join(game_dir, orig), temp)
+				replace(temp, join(game_dir, custom))
+				return CompletedProcess('decodeVCDiff', 0, b'')
+			except Exception as e:
+				if isfile(temp): remove(temp)
+				return CompletedProcess('decodeVCDiff', 1, ('%s: %s' % (patch, str(e).strip())).encode())
+		def external(patch):
+			orig, custom = source(patch), patches[patch][1]
+			temp = join(game_dir, custom + '.part')
+			try:
+				with ZipFile(patch_file, 'r') as file, file.open(patch) as member, open(temp, 'wb') as target:
+					# the errors are printed with the results
+					result = runTool([abspath(xdelta), '-d', '-c', '-s', orig], cwd=game_dir, stdin=member, stdout=target, echo=False)
+			except TimeoutError as e: result = CompletedProcess(xdelta, 1, ('%s: %s' % (patch, str(e))).encode())
+			if result.returncode == 0: replace(temp, join(game_dir, custom))
+			else: remove(temp)
+			return result
+		def apply(patch):
+			if infos[patch].file_size <= native_limit or xdelta is None:
+				decoders[patch] = 'built-in'
+				result = native(patch)
+				if result.returncode == 0 or xdelta is None: return result
+			decoders[patch] = 'xdelta'
+			return external(patch)
+		checkFreeSpace(game_dir, sum(size(patch) for patch in names) + (getsize(join(game_dir, image)) if romfs else 0), 'patching %s' % game_dir)
+		for patch in names: print('Apply', patch)
+		with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+			procs = dict(zip(sorted(names, key=size, reverse=True), executor.map(apply, sorted(names, key=size, reverse=True))))
+		
+		# print results
+		width = [max([len(patch) for patch in names] + [5]), max([len(patches[patch][1]) for patch in names] + [6]), 8]
+		print(' ', 'Patch'.ljust(width[0]), 'Target'.ljust(width[1]), 'Decoder'.ljust(width[2]), 'Result')
+		for patch in names:
+			print(' ', patch.ljust(width[0]), patches[patch][1].ljust(width[1]), decoders[patch].ljust(width[2]), 'OK' if procs[patch].returncode == 0 else 'FAILED')
+		failed = [patch for patch in names if procs[patch].returncode != 0]
+		if failed and not ignore_incompatible_patches:
+			raise Exception('\n'.join(procs[patch].stdout.decode(errors='replace').strip() for patch in failed))
+		for patch in failed:
+			print(procs[patch].stdout.decode(errors='replace').strip())
+			print('WARNING: Failed to apply', patch)
+		
+		# rebuild the RomFS with the patched files, moving the unchanged data by range
+		patched = {path: join(game_dir, patches[patch][1]) for patch, path in romfs.items() if procs[patch].returncode == 0}
+		if patched:
+			print('Rebuild CustomRomFS.bin from', image)
+			rebuildRomFS(join(game_dir, image), patched, join(game_dir, 'CustomRomFS.bin'))
+		if sources is not None:
+			sources.update(patches[patch][1] for patch in names if procs[patch].returncode == 0 and patch not in romfs)
+			if patched: sources.add('CustomRomFS.bin')
+		
 		print('Applied', patch_file)
 		print()
 		return True
@@ -527,9 +2017,83 @@ def applyPatches(patch_file, game_file, patches, xdelta, ignore_incompatible_pat
 		print()
 		return False
 
-def cleanUp(mappings = None, files = None):
+def createPatch(original_dir, modified_dir, patch_file, patches, xdelta, jobs = 1, source_window = 2**29):
+	""" Creates the [patch_file] containing a patch for each file that differs between [original_dir] and [modified_dir].
+		The file names are defined in [patches], the modified file is the custom file if it exists and the original file otherwise,
+		so both an extracted game folder and a patch game folder can be used as [modified_dir].
+		Files are compared by size and hash and up to [jobs] changed files are encoded with [xdelta] at the same time.
+		Files up to [source_window] bytes are encoded with a source window that covers the whole file.
+		The patches are written to temporary files and copied into the zip file one after another.
+	"""
+	from zipfile import ZipFile, ZIP_DEFLATED
+	from tempfile import mkdtemp
+	try:
+		print('Create', patch_file)
+		print(' ', 'from', original_dir)
+		print(' ', 'to', modified_dir)
+		
+		# list files
+		files = dict()
+		for patch, (orig, custom) in patches.items():
+			source = join(original_dir, orig)
+			target = join(modified_dir, custom) if isfile(join(modified_dir, custom)) else join(modified_dir, orig)
+			if isfile(source) and isfile(target): files[patch] = (source, target)
+		if not files: raise Exception('No files to compare found in %s and %s' % (original_dir, modified_dir))
+		
+		# compare files, the hashes are only needed if the sizes are equal
+		def changed(patch):
+			source, target = files[patch]
+			if getsize(source) != getsize(target): return True
+			if stat(source).st_ino == stat(target).st_ino and stat(source).st_dev == stat(target).st_dev: return False
+			return hashFile(source) != hashFile(target)
+		
+		# encode changed files, the window must be a power of two
+		temp_dir = mkdtemp(prefix='.GamePatcher', dir=split(abspath(patch_file))[0])
+		def encode(patch):
+			source, target = files[patch]
+			window = 1 << (max(min(getsize(source), source_window), 2**20) - 1).bit_length()
+			output = join(temp_dir, escapeName(patch))
+			proc = runTool([abspath(xdelta), '-e', '-f', '-S', 'none', '-B', str(window), '-s', abspath(source), abspath(target), output], echo=False)
+			if proc.returncode != 0: raise Exception('%s: %s' % (patch, proc.stdout.decode(errors='replace').strip()))
+			return output
+		try:
+			with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+				names = [patch for patch, result in zip(files, executor.map(changed, files)) if result]
+				if not names: raise Exception('No changed files found')
+				for patch in names: print('Encode', patch)
+				encoded = {patch: executor.submit(encode, patch) for patch in names}
+				# write zip file, the patches are added in a fixed order as soon as they are encoded
+				with ZipFile(patch_file + '.part', 'w', ZIP_DEFLATED) as archive:
+					for patch in names:
+						output = encoded[patch].result()
+						with open(output, 'rb') as src, archive.open(patch, 'w', force_zip64=True) as dst: copyfileobj(src, dst, 2**20)
+						remove(output)
+			replace(patch_file + '.part', patch_file)
+		finally:
+			rmtree(temp_dir, ignore_errors=True)
+			if isfile(patch_file + '.part'): remove(patch_file + '.part')
+		
+		# print results
+		width = [max([len(patch) for patch in files] + [5]), 9]
+		print(' ', 'Patch'.ljust(width[0]), 'Result')
+		with ZipFile(patch_file, 'r') as archive: sizes = {info.filename: info.file_size for info in archive.infolist()}
+		for patch in files:
+			print(' ', patch.ljust(width[0]), formatSize(sizes[patch]) if patch in sizes else 'unchanged')
+		
+		print('Created', patch_file)
+		print()
+		return True
+		
+	except Exception as e:
+		print(str(e).strip())
+		print('ERROR: Creating Failed')
+		print()
+		return False
+
+def cleanUp(mappings = None, files = None, workdirs = None):
 	""" Deletes all directories used by the given [mappings] and all given [files].
-		If [mappings] is None all directories will be deleted.
+		[workdirs] maps each game file to the directory containing its folders, which defaults to the current directory.
+		If [mappings] is None all directories in the current directory will be deleted.
 	"""
 	def rmdir(dir):
 		if not isdir(dir): return
@@ -541,8 +2105,9 @@ def cleanUp(mappings = None, files = None):
 		remove(file)
 	if mappings is not None: # delete mappings
 		for patch_file, game_file, _ in mappings:
-			rmdir(escapeName(game_file))
-			rmdir(escapeName(createName(game_file, patch_file)))
+			workdir = (workdirs or dict()).get(game_file, '.')
+			rmdir(join(workdir, escapeName(game_file)))
+			rmdir(join(workdir, escapeName(createName(game_file, patch_file))))
 	else: # delete all
 		for dir in [f for f in listdir('.') if isdir(f)]:
 			rmdir(dir)
@@ -550,36 +2115,92 @@ def cleanUp(mappings = None, files = None):
 		for file in files:
 			rmfile(file)
 
-class ValidateMapping(argparse.Action):
-	""" Validates a mapping.
-		Checks that the first and second arguments are a valid file.
-		Checks that the third argument is a version string or version number.
+def parseMapping(patch, game, version):
+	""" Validates a mapping and returns it as (patch, game, version).
+		Checks that [patch] and [game] are valid files, [patch] can also be a tuple of chained patch files.
+		Checks that [version] is a version string or version number and converts it to a number.
+	"""
+	# check values
+	for file in chainFiles(patch):
+		if not isfile(file): raise FileNotFoundError('No such file: \'%s\'' % file)
+		if splitext(file)[1] != '.zip':
+			raise ValueError('Unknown patch file format: \'%s\'' % splitext(file)[1])
+	if not isfile(game):  raise FileNotFoundError('No such file: \'%s\'' % game)
+	if splitext(game)[1].lower() not in ['.cia', '.3ds']:
+		raise ValueError('Unknown game file format: \'%s\'' % splitext(game)[1])
+	if not re.match('^v\d\.\d(\.\d)?$', version) and not version.isdigit():
+		raise ValueError('Not a valid version: \'%s\'' % version)
+	# convert version to int
+	ver = int(version) if version.isdigit() else version2int(version)
+	return patch, game, ver
+
+def readJobs(jobs_file, names):
+	""" Reads the jobs of a batch from the json file [jobs_file] and returns them as a list of dicts.
+		The file contains a list of objects with the keys patch, which can be a list of chained patch files, game and version and the optional keys
+		output, the path of the rebuilt game, and patches, which overrides the names of the patch files in [names]
+		using the names of the command line options as keys, e.g. {"code": "Code.xdelta"}.
 	"""
+	with open(jobs_file, 'r', encoding='utf-8') as file: entries = json.load(file)
+	if not isinstance(entries, list): raise ValueError('The jobs must be a list: \'%s\'' % jobs_file)
+	jobs = list()
+	for i, entry in enumerate(entries):
+		unknown = set(entry) - {'patch', 'game', 'version', 'output', 'patches'}
+		if unknown: raise ValueError('Unknown keys in job %d: %s' % (i+1, ', '.join(sorted(unknown))))
+		if not {'patch', 'game', 'version'} <= set(entry): raise ValueError('Job %d needs a patch, game and version' % (i+1))
+		patch = entry['patch'] if isinstance(entry['patch'], str) else tuple(entry['patch']) # a list is a chain
+		patch, game, version = parseMapping(patch, entry['game'], str(entry['version']))
+		unknown = set(entry.get('patches', dict())) - set(names)
+		if unknown: raise ValueError('Unknown patch files in job %d: %s' % (i+1, ', '.join(sorted(unknown))))
+		if any(job['patch'] == patch and job['game'] == game for job in jobs): # they would share the patch game folder
+			raise ValueError('Job %d applies %s to %s again' % (i+1, patch, game))
+		output = entry.get('output') or createName(game, patch)
+		if any(abspath(job['output']) == abspath(output) for job in jobs): # they would write the same file
+			raise ValueError('Job %d writes %s again' % (i+1, output))
+		jobs.append({
+			'patch': patch,
+			'game': game,
+			'version': version,
+			'output': output,
+			'names': dict(names, **entry.get('patches', dict())),
+		})
+	return jobs
+
+def writeResults(results_file, results):
+	""" Writes the [results] of a batch to the json file [results_file]. The file is replaced only when it is complete. """
+	with open(results_file + '.part', 'w', encoding='utf-8') as file: json.dump(results, file, indent=2, ensure_ascii=False)
+	replace(results_file + '.part', results_file)
+
+class ValidateMapping(argparse.Action):
+	""" Validates a mapping using parseMapping. """
 	def __call__(self, parser, args, values, option_string=None):
-		# unpack values
-		patch, game, version = values
-		# check values
-		if not isfile(patch): raise FileNotFoundError('No such file: \'%s\'' % patch)
-		if splitext(patch)[1] != '.zip':
-			raise ValueError('Unknown patch file format: \'%s\'' % splitext(game)[1])
-		if not isfile(game):  raise FileNotFoundError('No such file: \'%s\'' % game)
-		if splitext(game)[1].lower() not in ['.cia', '.3ds']:
-			raise ValueError('Unknown game file format: \'%s\'' % splitext(game)[1])
-		if not re.match('^v\d\.\d(\.\d)?$', version) and not version.isdigit():
-			raise ValueError('Not a valid version: \'%s\'' % version)
-		# convert version to int
-		ver = int(version) if version.isdigit() else version2int(version)
+		patch, game, ver = parseMapping(*values)
 		# add current mapping to list of mappings
 		if not hasattr(self, 'mappings'): self.mappings = list()
 		self.mappings.append((patch, game, ver))
 		# set attribute
 		setattr(args, self.dest, self.mappings)
 
+class ValidateChain(argparse.Action):
+	""" Validates a chain of patch files followed by a game and a version using parseMapping. """
+	def __call__(self, parser, args, values, option_string=None):
+		if len(values) < 4: raise ValueError('A chain needs at least two patch files, a game and a version.')
+		patch, game, ver = parseMapping(tuple(values[:-2]), values[-2], values[-1])
+		# add current chain to list of chains
+		if not hasattr(self, 'mappings'): self.mappings = list()
+		self.mappings.append((patch, game, ver))
+		# set attribute
+		setattr(args, self.dest, self.mappings)
+
 def main():
+	headless = batch = False
+	jobs = results = None
 	try:
-		# check updates
+		setTaskbarIcon()
+		
+		# check updates in the background, the result is only shown if it arrived in time
+		release = dict()
 		if len(sys.argv) <= 1:
-			if checkUpdates(): return
+			threading.Thread(target=lambda: release.update(result=latestRelease()), daemon=True).start()
 		
 		# check os
 		if 'windows' in platform.system().lower(): opSys = 'win'
@@ -591,9 +2212,46 @@ def main():
 		parser = argparse.ArgumentParser()
 		parser.add_argument('--mapping', metavar=('patch', 'game', 'version'), dest='mappings', nargs=3, action=ValidateMapping, \
 			help='Defines which patch file should be used to patch which game file. Can be used multiple times. When patching a CIA file specify the version as a string (v1.0.0) or integer (1024). When patching a 3DS file the version will be ignored.')
+		parser.add_argument('--chain', metavar='file', dest='chains', nargs='+', action=ValidateChain, \
+			help='Defines patch files that are applied one after another to the same game file, followed by the game file and the version, e.g. --chain base.zip fix.zip game.cia v1.0. Each patch file is applied to the output of the previous ones and the game is rebuilt once. Can be used multiple times.')
+		parser.add_argument('--batch', metavar='jobs', dest='batch', nargs=1, default=[None], \
+			help='Runs the jobs defined in this json file without asking any questions. Each job is an object with the keys patch, game, version and optionally output and patches. Exits with a non-zero code if any job fails.')
+		parser.add_argument('--batch-results', metavar='file', dest='batch_results', nargs=1, default=[None], \
+			help='The json file the result of each job of the batch is written to. Defaults to the jobs file with the extension .results.json.')
+		parser.add_argument('--create', metavar=('original', 'modified', 'patch'), dest='create', nargs=3, default=None, \
+			help='Creates the patch file from the files that differ between the original and the modified game folder instead of patching. The modified folder can be an extracted game folder or a patch game folder. Uses the names of the patch files defined below and encodes up to --jobs files at the same time.')
+		parser.add_argument('--source-window', metavar='bytes', dest='source_window', nargs=1, type=int, default=[2**29], \
+			help='The largest source window used by xdelta when creating a patch. Larger files like the RomFS find more matches with a larger window but xdelta needs as much memory.')
 		parser.add_argument('--ignore-incompatible-patches', dest='ignore_incompatible_patches', action='store_const', \
 			const=True, default=False, \
 			help='Continue patching when a patch cannot be applied instead of stopping the process.')
+		parser.add_argument('--jobs', metavar='N', dest='jobs', nargs=1, type=int, default=[1], \
+			help='The number of games that are patched or rebuilt and the number of patches that are applied at the same time.')
+		parser.add_argument('--io-jobs', metavar='N', dest='io_jobs', nargs=1, type=int, default=[None], \
+			help='The number of games that are extracted or copied at the same time. Defaults to the value of --jobs.')
+		parser.add_argument('--tool-jobs', metavar='N', dest='tool_jobs', nargs=1, type=int, default=[cpu_count() or 1], \
+			help='The number of external tools that run at the same time. Defaults to the number of processors.')
+		parser.add_argument('--tool-timeout', metavar='seconds', dest='tool_timeout', nargs=1, type=int, default=[0], \
+			help='The time after which an external tool is killed and its step fails. Use 0 to wait forever.')
+		parser.add_argument('--workspace', metavar='mode', dest='workspace', nargs=1, choices=['link', 'copy'], default=['link'], \
+			help='How the files of the original game are put into the patch game folder. With link they are reflinked or hardlinked where possible, with copy they are always copied.')
+		parser.add_argument('--workdir', metavar='dir', dest='workdir', nargs=1, default=[None], \
+			help='The directory for the extracted and patched game folders, for example a fast scratch disk. Games that do not fit are processed in the current directory.')
+		parser.add_argument('--low-disk', dest='low_disk', action='store_const', const=True, default=False, \
+			help='Delete every extracted and copied file as soon as it is no longer needed. The next execution has to extract the games again.')
+		parser.add_argument('--native-xdelta', dest='native_xdelta', action='store_const', \
+			const=True, default=False, \
+			help='Apply all patches with the built-in decoder instead of xdelta. Patches using features it does not support are still applied with xdelta.')
+		parser.add_argument('--native-xdelta-limit', metavar='bytes', dest='native_xdelta_limit', nargs=1, type=int, default=[4*1024*1024], \
+			help='The size up to which patches are applied with the built-in decoder instead of xdelta. Use 0 to always use xdelta.')
+		parser.add_argument('--profile', metavar='file', dest='profile', nargs=1, default=[None], \
+			help='Records the wall time, CPU time, bytes read and written and peak disk usage of each step, writes them to this json file and prints the slowest steps.')
+		parser.add_argument('--tool-cache', metavar='dir', dest='tool_cache', nargs=1, default=[toolCacheDir()], \
+			help='The directory where the downloaded tools are cached. The cache is shared by all working directories.')
+		parser.add_argument('--result-cache', metavar='dir', dest='result_cache', nargs=1, default=[None], \
+			help='Keeps the rebuilt games in this directory. A game that is rebuilt again from the same game file, patch files, version, tools and options is hardlinked from the cache instead of being patched again.')
+		parser.add_argument('--result-cache-size', metavar='bytes', dest='result_cache_size', nargs=1, type=int, default=[32*1024**3], \
+			help='The size up to which the result cache grows. The games that were used least recently are removed first.')
 		parser.add_argument('--xdelta-url', metavar='url', dest='xdelta_url', nargs=1, \
 			default=[TOOLS['xdelta'][opSys]['url']], \
 			help='The direct download link to xdelta. Supported file types are zip and exe.')
@@ -606,120 +2264,258 @@ def main():
 		parser.add_argument('--makerom-url', metavar='url', dest='makerom_url', nargs=1, \
 			default=[TOOLS['makerom'][opSys]['url']], \
 			help='The direct download link to makerom. Supported file types are zip and exe.')
-		parser.add_argument('--romfs', metavar='file', dest='patch_romfs', nargs=1, default='RomFS.xdelta', \
+		parser.add_argument('--romfs', metavar='file', dest='patch_romfs', nargs=1, default=['RomFS.xdelta'], \
 			help='The name of the patch file for DecryptedRomFS.bin')
-		parser.add_argument('--manual', metavar='file', dest='patch_manual', nargs=1, default='Manual.xdelta', \
+		parser.add_argument('--manual', metavar='file', dest='patch_manual', nargs=1, default=['Manual.xdelta'], \
 			help='The name of the patch file for DecryptedManual.bin')
-		parser.add_argument('--download-play', metavar='file', dest='patch_download_play', nargs=1, default='DownloadPlay.xdelta', \
+		parser.add_argument('--download-play', metavar='file', dest='patch_download_play', nargs=1, default=['DownloadPlay.xdelta'], \
 			help='The name of the patch file for DecryptedDownloadPlay.bin')
-		parser.add_argument('--banner', metavar='file', dest='patch_banner', nargs=1, default='banner.xdelta', \
+		parser.add_argument('--banner', metavar='file', dest='patch_banner', nargs=1, default=['banner.xdelta'], \
 			help='The name of the patch file for banner.bin')
-		parser.add_argument('--code', metavar='file', dest='patch_code', nargs=1, default='code.xdelta', \
+		parser.add_argument('--code', metavar='file', dest='patch_code', nargs=1, default=['code.xdelta'], \
 			help='The name of the patch file for code.bin')
-		parser.add_argument('--icon', metavar='file', dest='patch_icon', nargs=1, default='icon.xdelta', \
+		parser.add_argument('--icon', metavar='file', dest='patch_icon', nargs=1, default=['icon.xdelta'], \
 			help='The name of the patch file for icon.bin')
-		parser.add_argument('--logo', metavar='file', dest='patch_logo', nargs=1, default='LogoLZ.xdelta', \
+		parser.add_argument('--logo', metavar='file', dest='patch_logo', nargs=1, default=['LogoLZ.xdelta'], \
 			help='The name of the patch file for LogoLZ.bin')
-		parser.add_argument('--plain', metavar='file', dest='patch_plain', nargs=1, default='PlainRGN.xdelta', \
+		parser.add_argument('--plain', metavar='file', dest='patch_plain', nargs=1, default=['PlainRGN.xdelta'], \
 			help='The name of the patch file for LogoLZ.bin')
-		parser.add_argument('--ex-header', metavar='file', dest='patch_ex_header', nargs=1, default='ExHeader.xdelta', \
+		parser.add_argument('--ex-header', metavar='file', dest='patch_ex_header', nargs=1, default=['ExHeader.xdelta'], \
 			help='The name of the patch file for DecryptedExHeader.bin')
-		parser.add_argument('--header0', metavar='file', dest='patch_header0', nargs=1, default='HeaderNCCH0.xdelta', \
+		parser.add_argument('--header0', metavar='file', dest='patch_header0', nargs=1, default=['HeaderNCCH0.xdelta'], \
 			help='The name of the patch file for HeaderNCCH0.bin')
-		parser.add_argument('--header1', metavar='file', dest='patch_header1', nargs=1, default='HeaderNCCH1.xdelta', \
+		parser.add_argument('--header1', metavar='file', dest='patch_header1', nargs=1, default=['HeaderNCCH1.xdelta'], \
 			help='The name of the patch file for HeaderNCCH1.bin')
-		parser.add_argument('--header2', metavar='file', dest='patch_header2', nargs=1, default='HeaderNCCH2.xdelta', \
+		parser.add_argument('--header2', metavar='file', dest='patch_header2', nargs=1, default=['HeaderNCCH2.xdelta'], \
 			help='The name of the patch file for HeaderNCCH2.bin')
 		args = parser.parse_args()
+		batch = args.batch[0] is not None
+		headless = batch or args.create is not None
+		TOOL_RUNNER.limit = args.tool_jobs[0]
+		TOOL_RUNNER.timeout = args.tool_timeout[0]
 		
 		# title
-		printTitleBox()
+		if not headless: printTitleBox()
+		
+		# the files each patch is applied to by the name of its command line option
+		targets = {
+			'romfs':         ('DecryptedRomFS.bin', 'CustomRomFS.bin'),
+			'manual':        ('DecryptedManual.bin', 'CustomManual.bin'),
+			'download-play': ('DecryptedDownloadPlay.bin', 'CustomDownloadPlay.bin'),
+			'banner':        (join('ExtractedExeFS', 'banner.bin'), join('CustomExeFS', 'banner.bin')),
+			'code':          (join('ExtractedExeFS', 'code.bin'), join('CustomExeFS', 'code.bin')),
+			'icon':          (join('ExtractedExeFS', 'icon.bin'), join('CustomExeFS', 'icon.bin')),
+			'logo':          ('LogoLZ.bin', 'CustomLogoLZ.bin'),
+			'plain':         ('PlainRGN.bin', 'CustomPlainRGN.bin'),
+			'ex-header':     ('DecryptedExHeader.bin', 'CustomExHeader.bin'),
+			'header0':       ('HeaderNCCH0.bin', 'CustomHeaderNCCH0.bin'),
+			'header1':       ('HeaderNCCH1.bin', 'CustomHeaderNCCH1.bin'),
+			'header2':       ('HeaderNCCH2.bin', 'CustomHeaderNCCH2.bin')
+		}
+		names = {key: getattr(args, 'patch_' + key.replace('-', '_'))[0] for key in targets}
+		def tool(name, url): return cachedTool(name, url, opSys, args.tool_cache[0], TOOLS[name][opSys].get('sha256') if url == TOOLS[name][opSys]['url'] else None)
+		
+		# create a patch instead
+		if args.create is not None:
+			if args.mappings is not None or args.chains is not None or batch: raise ValueError('--create cannot be combined with --mapping, --chain or --batch.')
+			original_dir, modified_dir, patch_file = args.create
+			print('~~ Download Tools ~~')
+			xdelta = tool('xdelta', args.xdelta_url[0])
+			print()
+			print('~~ Create Patch ~~')
+			success = createPatch(original_dir, modified_dir, patch_file, {names[key]: target for key, target in targets.items()}, xdelta, \
+				jobs=args.jobs[0], source_window=args.source_window[0])
+			return 0 if success else 1
 		
 		# mappings
-		if args.mappings is not None:
-			mappings = set(args.mappings)
+		if batch:
+			if args.mappings is not None or args.chains is not None: raise ValueError('--batch cannot be combined with --mapping or --chain.')
+			jobs = readJobs(args.batch[0], names)
 		else:
-			mappings = automaticMappings()
-			if mappings is None:
-				if len(sys.argv) <= 1: mappings = askMappings()
-				else: raise ValueError('The mappings could not be assigned automatically.')
-		mappings = sorted(mappings)
-		
-		# patches
-		patches = {
-			args.patch_romfs:         ('DecryptedRomFS.bin', 'CustomRomFS.bin'),
-			args.patch_manual:        ('DecryptedManual.bin', 'CustomManual.bin'),
-			args.patch_download_play: ('DecryptedDownloadPlay.bin', 'CustomDownloadPlay.bin'),
-			args.patch_banner:        (join('ExtractedExeFS', 'banner.bin'), join('CustomExeFS', 'banner.bin')),
-			args.patch_code:          (join('ExtractedExeFS', 'code.bin'), join('CustomExeFS', 'code.bin')),
-			args.patch_icon:          (join('ExtractedExeFS', 'icon.bin'), join('CustomExeFS', 'icon.bin')),
-			args.patch_logo:          ('LogoLZ.bin', 'CustomLogoLZ.bin'),
-			args.patch_plain:         ('PlainRGN.bin', 'CustomPlainRGN.bin'),
-			args.patch_ex_header:     ('DecryptedExHeader.bin', 'CustomExHeader.bin'),
-			args.patch_header0:       ('HeaderNCCH0.bin', 'CustomHeaderNCCH0.bin'),
-			args.patch_header1:       ('HeaderNCCH1.bin', 'CustomHeaderNCCH1.bin'),
-			args.patch_header2:       ('HeaderNCCH2.bin', 'CustomHeaderNCCH2.bin')
-		}
+			if args.mappings is not None or args.chains is not None:
+				mappings = set(args.mappings or list()) | set(args.chains or list())
+			else:
+				mappings = automaticMappings()
+				if mappings is None:
+					if len(sys.argv) <= 1: mappings = askMappings()
+					else: raise ValueError('The mappings could not be assigned automatically.')
+			jobs = [{'patch': patch_file, 'game': game_file, 'version': version, 'output': createName(game_file, patch_file), 'names': names} for patch_file, game_file, version in sorted(mappings, key=lambda mapping: (chainFiles(mapping[0]), mapping[1], mapping[2]))]
+		mappings = [(job['patch'], job['game'], job['version']) for job in jobs]
+		
+		# patches and output of each mapping
+		patches = {(job['patch'], job['game']): {job['names'][key]: target for key, target in targets.items()} for job in jobs}
+		outputs = {(job['patch'], job['game']): job['output'] for job in jobs}
+		
+		# new version
+		if release.get('result') and checkUpdates(release.pop('result')): return
+		
+		# games that were rebuilt before are taken from the result cache
+		cache = args.result_cache[0]
+		result_keys, cached = dict(), set()
+		if cache is not None:
+			print('~~ Result Cache ~~')
+			tools = {'xdelta': args.xdelta_url[0], '3dstool': args.dstool_url[0], 'ctrtool': args.ctrtool_url[0], 'makerom': args.makerom_url[0]}
+			for job in jobs:
+				mapping = (job['patch'], job['game'])
+				try:
+					result_keys[mapping] = resultKey(cache, job['patch'], job['game'], job['version'], job['names'], tools, {'ignore_incompatible_patches': args.ignore_incompatible_patches})
+					if fetchResult(cache, result_keys[mapping], job['output']):
+						print('Found', job['output'])
+						cached.add(mapping)
+				except Exception as e:
+					print(str(e).strip())
+					print('WARNING: Failed to use the result cache for', job['output'])
+			if not cached: print('No game found')
+			print()
+		remaining = [mapping for mapping in mappings if mapping[:2] not in cached]
 		
 		# main
 		print('~~ Download Tools ~~')
-		downloadTool(args.xdelta_url[0],  TOOLS['xdelta'][opSys]['exe'])
-		downloadTool(args.dstool_url[0],  TOOLS['3dstool'][opSys]['exe'])
-		downloadTool(args.ctrtool_url[0], TOOLS['ctrtool'][opSys]['exe'])
-		downloadTool(args.makerom_url[0], TOOLS['makerom'][opSys]['exe'])
-		print()
-		
-		print('~~ Extract Games ~~')
-		fails = list()
-		for game_file in sorted({game for _, game, _ in mappings}, key=lambda x: next(i for i, (_, x2, _) in enumerate(mappings) if x == x2)):
-			success = extractGame(game_file, dstool=TOOLS['3dstool'][opSys]['exe'], ctrtool=TOOLS['ctrtool'][opSys]['exe'])
-			if not success: fails.append(game_file)
+		native_limit = float('inf') if args.native_xdelta else args.native_xdelta_limit[0]
+		def needed(patch_file, game_file):
+			try: return any(needsXdelta(file, patches[(patch_file, game_file)], native_limit) for file in chainFiles(patch_file))
+			except Exception: return True # applying the patch will report the error
+		if not remaining:
+			print('Skip the tools, all games were found in the result cache')
+			xdelta = dstool = ctrtool = makerom = None
+		else:
+			if any(needed(patch_file, game_file) for patch_file, game_file, _ in remaining):
+				xdelta = tool('xdelta', args.xdelta_url[0])
+			else:
+				print('Skip xdelta, all patches are applied with the built-in decoder')
+				xdelta = None
+			dstool  = tool('3dstool', args.dstool_url[0])
+			ctrtool = tool('ctrtool', args.ctrtool_url[0])
+			makerom = tool('makerom', args.makerom_url[0])
 		print()
 		
 		print('~~ Patch Games ~~')
-		for patch_file, game_file, _ in mappings:
-			if game_file in fails:
-				print('Skip', patch_file, '→', game_file)
-				fails.append((patch_file, game_file))
-				continue
-			prepareGame(patch_file, game_file)
-			success = applyPatches(patch_file, game_file, patches, xdelta=TOOLS['xdelta'][opSys]['exe'], ignore_incompatible_patches=args.ignore_incompatible_patches)
-			if not success: fails.append((patch_file, game_file))
+		# each game is extracted once, every mapping continues as soon as the steps it depends on are finished
+		games = sorted({game for _, game, _ in remaining}, key=lambda x: next(i for i, (_, x2, _) in enumerate(remaining) if x == x2))
+		parts = {game_file: set() for game_file in games}
+		for patch_file, game_file, _ in remaining:
+			if parts[game_file] is None: continue
+			try:
+				for file in chainFiles(patch_file): parts[game_file] |= requiredParts(file, patches[(patch_file, game_file)])
+			except Exception: parts[game_file] = None # extract everything, applying the patch will report the error
+		# the folders of a game are put into the work directory if they fit, otherwise into the current directory
+		workdirs = {game_file: '.' for game_file in games}
+		if args.workdir[0] is not None:
+			makedirs(args.workdir[0], exist_ok=True)
+			available = disk_usage(args.workdir[0]).free
+			for game_file in games:
+				size = getsize(game_file) * (1 + len([mapping for mapping in remaining if mapping[1] == game_file]))
+				if size <= available:
+					workdirs[game_file] = args.workdir[0]
+					available -= size
+				else: print('Use the current directory for %s, %s needs about %s but only %s are available' % (game_file, args.workdir[0], formatSize(size), formatSize(available)))
+		gameDir = lambda game_file: join(workdirs[game_file], escapeName(game_file))
+		patchDir = lambda patch_file, game_file: join(workdirs[game_file], escapeName(createName(game_file, patch_file)))
+		global PROFILE
+		if args.profile[0] is not None:
+			PROFILE = Profile([gameDir(game_file) for game_file in games] + [patchDir(patch_file, game_file) for patch_file, game_file, _ in remaining] + list(outputs.values()))
+		def profiled(task, step, func):
+			if PROFILE is None: return func
+			def call():
+				with PROFILE.task(task):
+					PROFILE.step(step)
+					return func()
+			return call
+		tasks = dict()
+		for game_file in games:
+			tasks[('extract', game_file)] = (profiled(game_file, 'Extracting', lambda game_file=game_file: extractGame(game_file, dstool=dstool, ctrtool=ctrtool, parts=parts[game_file], workdir=workdirs[game_file])), [], 'io')
+		for patch_file, game_file, version in remaining:
+			mapping = '%s → %s' % (' + '.join(chainFiles(patch_file)), game_file)
+			tasks[('prepare', patch_file, game_file)] = (profiled(mapping, 'Copying', lambda patch_file=patch_file, game_file=game_file: prepareGame(patch_file, game_file, workspace=args.workspace[0], workdir=workdirs[game_file])), \
+				[('extract', game_file)], 'io')
+			tasks[('apply', patch_file, game_file)] = (profiled(mapping, 'Patching', lambda patch_file=patch_file, game_file=game_file: applyPatches(patch_file, game_file, patches[(patch_file, game_file)], xdelta=xdelta, \
+				ignore_incompatible_patches=args.ignore_incompatible_patches, jobs=args.jobs[0], native_limit=native_limit, workdir=workdirs[game_file])), [('prepare', patch_file, game_file)], 'cpu')
+			tasks[('rebuild', patch_file, game_file)] = (profiled(mapping, 'Rebuilding', lambda patch_file=patch_file, game_file=game_file, version=version: rebuildGame(patch_file, game_file, version, dstool=dstool, makerom=makerom, low_disk=args.low_disk, workdir=workdirs[game_file], output=outputs[(patch_file, game_file)])), \
+				[('apply', patch_file, game_file)], 'cpu')
+			if (patch_file, game_file) in result_keys:
+				tasks[('cache', patch_file, game_file)] = (lambda patch_file=patch_file, game_file=game_file: storeResult(cache, result_keys[(patch_file, game_file)], outputs[(patch_file, game_file)], args.result_cache_size[0]), \
+					[('rebuild', patch_file, game_file)], 'io')
+		if args.low_disk: # delete the folders after their last use
+			def free(dir):
+				print('Delete', dir)
+				rmtree(dir)
+				print()
+				return True
+			for game_file in games: # the patch game folders can link to the extracted files through symlinks until they are rebuilt
+				tasks[('free', game_file)] = (lambda game_file=game_file: free(gameDir(game_file)), [('rebuild', p, g) for p, g, _ in remaining if g == game_file], 'io')
+			for patch_file, game_file, _ in remaining:
+				tasks[('free', patch_file, game_file)] = (lambda patch_file=patch_file, game_file=game_file: free(patchDir(patch_file, game_file)), [('rebuild', patch_file, game_file)], 'io')
+		with PROFILE if PROFILE is not None else nullcontext():
+			results = runGraph(tasks, {'cpu': max(args.jobs[0], 1), 'io': max(args.io_jobs[0] or args.jobs[0], 1)})
 		print()
 		
-		print('~~ Rebuild Games ~~')
+		print('~~ Summary ~~')
+		steps = {'extract': 'Extracting', 'prepare': 'Copying', 'apply': 'Patching', 'rebuild': 'Rebuilding'}
+		summary = list()
 		for patch_file, game_file, version in mappings:
-			if (patch_file, game_file) in fails:
-				print('Skip', patch_file, '→', game_file)
-				continue
-			success = rebuildGame(patch_file, game_file, version, dstool=TOOLS['3dstool'][opSys]['exe'], makerom=TOOLS['makerom'][opSys]['exe'])
-			if not success: fails.append((patch_file, game_file))
-		print()
+			cached_result = (patch_file, game_file) in cached
+			keys = [] if cached_result else [('extract', game_file)] + [(step, patch_file, game_file) for step in ['prepare', 'apply', 'rebuild']]
+			failed = next((key[0] for key in keys if results[key] is False), None)
+			if failed: print('Failed', ' + '.join(chainFiles(patch_file)), '→', game_file, '(%s Failed)' % steps[failed])
+			elif cached_result: print('Created', outputs[(patch_file, game_file)], '(cached)')
+			else: print('Created', outputs[(patch_file, game_file)])
+			summary.append({'patch': patch_file, 'game': game_file, 'version': int2version(version), 'output': outputs[(patch_file, game_file)], \
+				'success': failed is None, 'failed_step': steps[failed] if failed else None, 'cached': cached_result})
+		if PROFILE is not None:
+			PROFILE.write(args.profile[0])
+			print()
+			print('Profile written to', args.profile[0])
+			PROFILE.printSummary()
 		
-		print('~~ Summary ~~')
-		for patch_file, game_file, _ in mappings:
-			if (patch_file, game_file) in fails: print('Failed', patch_file, '→', game_file)
-			else: print('Created', createName(game_file, patch_file))
+		# batches end without any questions
+		if batch:
+			results_file = args.batch_results[0] or splitext(args.batch[0])[0] + '.results.json'
+			writeResults(results_file, summary)
+			print()
+			print('Results written to', results_file)
+			return 0 if all(result['success'] for result in summary) else 1
+		
+		if release.get('result'):
+			print()
+			print('A new version of Game Patcher is available: %s (%s)' % release['result'])
 		
 		print()
 		command = input('Finished. Clean up? [y/n/all] ').strip()
 		if command in ['y', 'all']:
 			print()
 			print('~~ Clean Up ~~')
-			if command == 'y': cleanUp(mappings=mappings)
-			else: cleanUp(mappings=None, files=[tool[opSys]['exe'] for tool in TOOLS.values()])
+			if command == 'y': cleanUp(mappings=mappings, workdirs=workdirs)
+			else:
+				cleanUp(mappings=mappings, workdirs=workdirs)
+				cleanUp(mappings=None, files=[tool[opSys]['exe'] for tool in TOOLS.values()]) # tools downloaded by older versions
 			print()
 			input('Press Enter to exit...')
 		
 	except KeyboardInterrupt as e:
+		TOOL_RUNNER.stop()
 		print('KeyboardInterrupt')
 		print()
+		if headless: return 130
 		input('Press Enter to exit...')
 	except Exception as e:
 		import traceback
 		traceback.print_exc()
 		print()
+		if batch and results is None: # the batch failed before its games were patched, so every job failed
+			if jobs is None: # the jobs could not be read, their entries are reported as they are
+				try:
+					with open(args.batch[0], 'r', encoding='utf-8') as file: jobs = [entry for entry in json.load(file) if isinstance(entry, dict)]
+				except Exception: jobs = list()
+			results_file = args.batch_results[0] or splitext(args.batch[0])[0] + '.results.json'
+			try:
+				writeResults(results_file, [{'patch': job.get('patch'), 'game': job.get('game'), \
+					'version': int2version(job['version']) if isinstance(job.get('version'), int) else job.get('version'), \
+					'output': job.get('output'), 'success': False, 'failed_step': 'Setup', 'cached': False} for job in jobs])
+				print('Results written to', results_file)
+			except Exception as e: print(str(e).strip())
+			print()
+		if headless: return 1
 		input('Press Enter to exit...')
 
 if __name__ == '__main__':
-	main()
+	sys.exit(main())
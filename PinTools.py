@@ -0,0 +1,51 @@
+""" Author: Dominik Beese
+>>> Game Patcher Tool Pinning
+	Downloads the default release assets of the tools and pins their SHA-256 hashes in GamePatcher.py.
+<<<
+"""
+
+import argparse
+import re
+import hashlib
+from os.path import join, split, abspath
+from tempfile import TemporaryDirectory
+
+from GamePatcher import TOOLS, downloadFile
+
+
+def assetHash(download_url, temp_dir):
+	""" Downloads [download_url] into [temp_dir] and returns its SHA-256 hash. """
+	filename = join(temp_dir, hashlib.sha256(download_url.encode()).hexdigest())
+	downloadFile(download_url, filename)
+	hash = hashlib.sha256()
+	with open(filename, 'rb') as file:
+		for chunk in iter(lambda: file.read(2**20), b''): hash.update(chunk)
+	return hash.hexdigest()
+
+def pinHash(source, download_url, sha256):
+	""" Returns the [source] of GamePatcher.py with the [sha256] hash set in every entry of TOOLS that downloads [download_url]. """
+	def pin(match):
+		entry = re.sub(r",\s*'sha256':\s*'[0-9a-fA-F]*'", '', match.group(0))
+		return entry[:-1] + ", 'sha256': '%s'}" % sha256
+	return re.sub(r"\{'url': r'%s'[^{}]*\}" % re.escape(download_url), pin, source)
+
+def main():
+	parser = argparse.ArgumentParser(description='Downloads the default release assets of the tools and pins their SHA-256 hashes in GamePatcher.py.')
+	parser.add_argument('--all', dest='all', action='store_const', const=True, default=False, \
+		help='Download and pin all assets again instead of only the ones without a hash.')
+	args = parser.parse_args()
+	
+	filename = join(split(abspath(__file__))[0], 'GamePatcher.py')
+	with open(filename, 'r', encoding='utf-8') as file: source = file.read()
+	urls = sorted({entry['url'] for tool in TOOLS.values() for key, entry in tool.items() if key != 'version' and (args.all or 'sha256' not in entry)})
+	with TemporaryDirectory() as temp_dir:
+		for download_url in urls:
+			print('Downloading', download_url)
+			sha256 = assetHash(download_url, temp_dir)
+			source = pinHash(source, download_url, sha256)
+			print()
+	with open(filename, 'w', encoding='utf-8') as file: file.write(source)
+	print('Pinned', len(urls), 'downloads in', filename)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,98 @@
+""" Tests downloadFile against a local HTTP server. """
+
+import sys
+import hashlib
+import threading
+import unittest
+from os import listdir
+from os.path import join, split, abspath, isfile
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from tempfile import TemporaryDirectory
+from contextlib import redirect_stdout
+from io import StringIO
+
+sys.path.insert(0, split(split(abspath(__file__))[0])[0])
+from GamePatcher import downloadFile
+
+DATA = bytes(range(256)) * 4096 # 1 MiB
+
+class Handler(BaseHTTPRequestHandler):
+	""" Serves DATA, honours range requests if [ranges] is set and closes the connection
+		after [drop] bytes of the first response if [drop] is set. Records the Range header of each request.
+	"""
+	ranges = True
+	drop = None
+	requests = list()
+	
+	def do_GET(self):
+		header = self.headers.get('Range')
+		type(self).requests.append(header)
+		start = int(header[6:-1]) if header and self.ranges else 0
+		if start >= len(DATA):
+			self.send_response(416)
+			self.end_headers()
+			return
+		self.send_response(206 if start else 200)
+		if start: self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(DATA)-1, len(DATA)))
+		self.send_header('Content-Length', str(len(DATA) - start))
+		self.end_headers()
+		if self.drop is not None and len(type(self).requests) == 1:
+			self.wfile.write(DATA[start:start+self.drop])
+			self.wfile.flush()
+			self.close_connection = True
+			return
+		self.wfile.write(DATA[start:])
+	
+	def log_message(self, *args): pass
+
+class DownloadFileTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.dir = TemporaryDirectory()
+		self.file = join(self.dir.name, 'tool.zip')
+		Handler.ranges, Handler.drop, Handler.requests = True, None, list()
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		self.url = 'http://127.0.0.1:%d/tool.zip' % self.server.server_address[1]
+	
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.dir.cleanup()
+	
+	def download(self, sha256 = None):
+		with redirect_stdout(StringIO()): downloadFile(self.url, self.file, sha256)
+		with open(self.file, 'rb') as file: return file.read()
+	
+	def test_download(self):
+		self.assertEqual(self.download(hashlib.sha256(DATA).hexdigest()), DATA)
+		self.assertEqual(listdir(self.dir.name), ['tool.zip'])
+	
+	def test_resume(self):
+		with open(self.file + '.part', 'wb') as file: file.write(DATA[:1000])
+		self.assertEqual(self.download(), DATA)
+		self.assertEqual(Handler.requests, ['bytes=1000-'])
+	
+	def test_range_ignored(self):
+		Handler.ranges = False
+		with open(self.file + '.part', 'wb') as file: file.write(DATA[:1000])
+		self.assertEqual(self.download(), DATA)
+		self.assertEqual(Handler.requests, ['bytes=1000-'])
+	
+	def test_already_complete(self):
+		with open(self.file + '.part', 'wb') as file: file.write(DATA)
+		self.assertEqual(self.download(hashlib.sha256(DATA).hexdigest()), DATA)
+	
+	def test_dropped_connection(self):
+		Handler.drop = 300000
+		self.assertEqual(self.download(hashlib.sha256(DATA).hexdigest()), DATA)
+		self.assertEqual(Handler.requests, [None, 'bytes=300000-'])
+	
+	def test_hash_mismatch(self):
+		with self.assertRaises(Exception), redirect_stdout(StringIO()):
+			downloadFile(self.url, self.file, '0' * 64)
+		self.assertFalse(isfile(self.file))
+		self.assertFalse(isfile(self.file + '.part'))
+
+if __name__ == '__main__':
+	unittest.main()
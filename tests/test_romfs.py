@@ -0,0 +1,297 @@
+""" Tests the RomFS, ExeFS and container functions against synthetic images.
+	The RomFS images are laid out like the ones created by 3dstool: the IVFC header is followed by the master hash,
+	level 3, level 1 and level 2, the file data in level 3 is aligned to 0x10 bytes and the names are UTF-16.
+"""
+
+import sys
+import struct
+import hashlib
+import unittest
+from os import listdir, makedirs
+from os.path import join, split, abspath
+from random import Random
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, split(split(abspath(__file__))[0])[0])
+from GamePatcher import hashBlocks, romfsLayout, romfsFiles, extractRomFS, rebuildRomFS, unpackExeFS, packExeFS, ciaContents, ncsdPartitions, splitGame
+
+NONE = 0xFFFFFFFF
+
+def buildRomFS(tree, romfs_file, block_size = 0x1000, padded = True):
+	""" Writes a RomFS containing the [tree], a dict of name → data or dict, to [romfs_file].
+		All levels use [block_size]. If [padded] is True the file is padded to a multiple of the block size.
+	"""
+	dirs, files, data = bytearray(), bytearray(), bytearray()
+	def addDir(name, parent):
+		offset, name = len(dirs), name.encode('utf-16-le')
+		dirs.extend(struct.pack('<6I', parent, NONE, NONE, NONE, NONE, len(name)) + name + bytes(-len(name) % 4))
+		return offset
+	def addFiles(node, dir):
+		previous = None
+		for name, content in sorted(node.items()):
+			if isinstance(content, dict): continue
+			entry, name = len(files), name.encode('utf-16-le')
+			data.extend(bytes(-len(data) % 0x10))
+			files.extend(struct.pack('<IIQQII', dir, NONE, len(data), len(content), NONE, len(name)) + name + bytes(-len(name) % 4))
+			data.extend(content)
+			if previous is None: struct.pack_into('<I', dirs, dir + 0x0C, entry)
+			else: struct.pack_into('<I', files, previous + 4, entry)
+			previous = entry
+		previous = None
+		for name, content in sorted(node.items()):
+			if not isinstance(content, dict): continue
+			child = addDir(name, dir)
+			if previous is None: struct.pack_into('<I', dirs, dir + 0x08, child)
+			else: struct.pack_into('<I', dirs, previous + 4, child)
+			previous = child
+			addFiles(content, child)
+	addFiles(tree, addDir('', 0))
+	# level 3 header, empty hash tables, the tables and the data
+	tables, offset = list(), 0x28
+	for table in [bytes(12), dirs, bytes(12), files]:
+		tables += [offset, len(table)]
+		offset += len(table)
+	level3 = bytearray(struct.pack('<10I', 0x28, *tables, offset + -offset % 0x10) + bytes(12) + dirs + bytes(12) + files)
+	level3 += bytes(-len(level3) % 0x10) + data
+	level2 = hashBlocks(level3, block_size)
+	level1 = hashBlocks(level2, block_size)
+	master = hashBlocks(level1, block_size)
+	align = lambda value: -(-value // block_size) * block_size
+	bits = block_size.bit_length() - 1
+	header = b'IVFC' + struct.pack('<II', 0x10000, len(master))
+	header += struct.pack('<QQII', 0, len(level1), bits, 0)
+	header += struct.pack('<QQII', align(len(level1)), len(level2), bits, 0)
+	header += struct.pack('<QQII', align(align(len(level1)) + len(level2)), len(level3), bits, 0)
+	image = bytearray(header + struct.pack('<III', 0, 0x5C, 0) + master)
+	for level in [level3, level1, level2]:
+		image += bytes(align(len(image)) - len(image)) + level
+	if padded: image += bytes(align(len(image)) - len(image))
+	with open(romfs_file, 'wb') as file: file.write(image)
+
+def flatten(tree, path = ''):
+	""" Returns the files in [tree] as a dict of path → data. """
+	files = dict()
+	for name, content in tree.items():
+		if isinstance(content, dict): files.update(flatten(content, path + name + '/'))
+		else: files[path + name] = content
+	return files
+
+class RomFSTest(unittest.TestCase):
+
+	TREE = {
+		'a.bin': b'A' * 5000,
+		'b.bin': b'',
+		'c.bin': b'C' * 0x1000,
+		'data': {'d.bin': b'D' * 100, 'e.bin': b'E' * 9000, 'sub': {'f.bin': b'F' * 3}},
+		'text': {'msg_ä.bin': b'MSG' * 2000},
+	}
+
+	def check(self, romfs_file, expected):
+		""" Checks the whole hash tree of [romfs_file] and that it contains exactly the [expected] files. """
+		layout = romfsLayout(romfs_file)
+		(o1, o2, o3), (s1, s2, s3), (b1, b2, b3) = layout['offsets'], layout['sizes'], layout['blocks']
+		with open(romfs_file, 'rb') as file: image = file.read()
+		self.assertEqual(hashBlocks(image[o3:o3+s3], b3), image[o2:o2+s2])
+		self.assertEqual(hashBlocks(image[o2:o2+s2], b2), image[o1:o1+s1])
+		self.assertEqual(hashBlocks(image[o1:o1+s1], b1), image[0x60:0x60+layout['master']])
+		files = romfsFiles(romfs_file, layout)
+		self.assertEqual({path: image[o3+offset:o3+offset+size] for path, (_, offset, size) in files.items()}, expected)
+		return layout
+
+	def rebuild(self, tree, changes, block_size = 0x1000, padded = True, chain = 1):
+		""" Builds a RomFS from [tree] and rebuilds it [chain] times, each time with the files in [changes] replaced. """
+		expected = flatten(tree)
+		with TemporaryDirectory() as dir:
+			buildRomFS(tree, join(dir, 'RomFS0.bin'), block_size, padded)
+			self.check(join(dir, 'RomFS0.bin'), expected)
+			for step in range(chain):
+				files = dict()
+				for i, (path, content) in enumerate(changes.items()):
+					files[path] = join(dir, 'file%d.bin' % i)
+					with open(files[path], 'wb') as file: file.write(content[step:])
+					expected[path] = content[step:]
+				rebuildRomFS(join(dir, 'RomFS%d.bin' % step), files, join(dir, 'RomFS%d.bin' % (step + 1)))
+				self.assertNotIn('RomFS%d.bin.part' % (step + 1), listdir(dir))
+				layout = self.check(join(dir, 'RomFS%d.bin' % (step + 1)), expected)
+				self.assertEqual(layout['padded'], padded or layout['end'] % block_size == 0)
+
+	def test_unchanged(self):
+		self.rebuild(self.TREE, {})
+
+	def test_grow(self):
+		self.rebuild(self.TREE, {'data/d.bin': b'd' * 20000})
+
+	def test_shrink(self):
+		self.rebuild(self.TREE, {'data/e.bin': b'e' * 10})
+
+	def test_zero_size(self):
+		self.rebuild(self.TREE, {'a.bin': b'', 'b.bin': b'b' * 7000})
+
+	def test_first(self):
+		self.rebuild(self.TREE, {'a.bin': b'a' * 12345})
+
+	def test_last(self):
+		self.rebuild(self.TREE, {'text/msg_ä.bin': b'm' * 30000})
+
+	def test_consecutive(self):
+		self.rebuild(self.TREE, {'c.bin': b'c' * 5, 'data/d.bin': b'd' * 8000, 'data/e.bin': b'e' * 4096})
+
+	def test_unpadded(self):
+		self.rebuild(self.TREE, {'data/sub/f.bin': b'f' * 6000}, padded=False)
+
+	def test_small_blocks(self):
+		self.rebuild(self.TREE, {'a.bin': b'a' * 300, 'data/sub/f.bin': b'f' * 1500}, block_size=0x200)
+
+	def test_chain(self):
+		self.rebuild(self.TREE, {'a.bin': b'a' * 9000, 'data/e.bin': b'e' * 100}, chain=3)
+
+	def test_fuzz(self):
+		random = Random(0)
+		for trial in range(30):
+			tree = dict()
+			for i in range(random.randint(1, 20)):
+				node = tree
+				for name in random.sample(['a', 'b', 'ä'], random.randint(0, 2)): node = node.setdefault(name, dict())
+				node['f%d.bin' % i] = random.randbytes(random.choice([0, 1, 15, 16, 100, 511, 512, 4095, 4096, 4097, 9000]))
+			files = flatten(tree)
+			changes = {path: random.randbytes(random.choice([0, 3, len(files[path]), len(files[path]) + 700, len(files[path]) // 2, 20000]))
+				for path in random.sample(sorted(files), random.randint(1, min(4, len(files))))}
+			with self.subTest(trial=trial):
+				self.rebuild(tree, changes, random.choice([0x200, 0x1000]), random.random() < 0.7, random.randint(1, 2))
+
+	def test_extract(self):
+		with TemporaryDirectory() as dir:
+			buildRomFS(self.TREE, join(dir, 'RomFS.bin'))
+			extractRomFS(join(dir, 'RomFS.bin'), ['b.bin', 'data/sub/f.bin', 'text/msg_ä.bin'], join(dir, 'ExtractedRomFS'))
+			for path in ['b.bin', 'data/sub/f.bin', 'text/msg_ä.bin']:
+				with open(join(dir, 'ExtractedRomFS', *path.split('/')), 'rb') as file: self.assertEqual(file.read(), flatten(self.TREE)[path])
+			with self.assertRaises(ValueError): extractRomFS(join(dir, 'RomFS.bin'), ['missing.bin'], join(dir, 'ExtractedRomFS'))
+
+	def test_invalid(self):
+		with TemporaryDirectory() as dir:
+			buildRomFS(self.TREE, join(dir, 'RomFS.bin'))
+			with open(join(dir, 'RomFS.bin'), 'rb') as file: image = bytearray(file.read())
+			layout = romfsLayout(join(dir, 'RomFS.bin'))
+			with open(join(dir, 'file.bin'), 'wb') as file: file.write(b'x')
+			with self.assertRaises(ValueError): rebuildRomFS(join(dir, 'RomFS.bin'), {'missing.bin': join(dir, 'file.bin')}, join(dir, 'Custom.bin'))
+			for position in [0, layout['offsets'][0], layout['offsets'][1], layout['offsets'][2] + 0x100]: # header, level 1, level 2, level 3
+				corrupted = bytearray(image)
+				corrupted[position] ^= 0xFF
+				with open(join(dir, 'Corrupted.bin'), 'wb') as file: file.write(corrupted)
+				with self.subTest(position=position), self.assertRaises(ValueError): romfsLayout(join(dir, 'Corrupted.bin'))
+			with open(join(dir, 'Corrupted.bin'), 'wb') as file: file.write(image[:-0x10])
+			with self.assertRaises(ValueError): romfsLayout(join(dir, 'Corrupted.bin'))
+
+def buildExeFS(files):
+	""" Returns an ExeFS containing the [files], a list of (name, data). """
+	header, body = bytearray(0x200), bytearray()
+	for i, (name, data) in enumerate(files):
+		header[i*0x10:i*0x10+0x10] = name.encode('ascii').ljust(8, b'\0') + struct.pack('<II', len(body), len(data))
+		header[0x1E0-i*0x20:0x200-i*0x20] = hashlib.sha256(data).digest()
+		body += data + bytes(-len(data) % 0x200)
+	return bytes(header + body)
+
+class ExeFSTest(unittest.TestCase):
+
+	FILES = [('.code', b'CODE' * 1000), ('banner', b'BANNER' * 100), ('icon', b'ICON' * 0x80), ('logo', b'')]
+
+	def test_round_trip(self):
+		with TemporaryDirectory() as dir:
+			with open(join(dir, 'ExeFS.bin'), 'wb') as file: file.write(buildExeFS(self.FILES))
+			unpackExeFS(join(dir, 'ExeFS.bin'), join(dir, 'ExtractedExeFS'), join(dir, 'HeaderExeFS.bin'))
+			self.assertEqual(sorted(listdir(join(dir, 'ExtractedExeFS'))), ['banner.bin', 'code.bin', 'icon.bin', 'logo.bin'])
+			for name, data in self.FILES:
+				with open(join(dir, 'ExtractedExeFS', 'code.bin' if name == '.code' else name + '.bin'), 'rb') as file: self.assertEqual(file.read(), data)
+			packExeFS(join(dir, 'ExtractedExeFS'), join(dir, 'HeaderExeFS.bin'), join(dir, 'Custom.bin'))
+			with open(join(dir, 'ExeFS.bin'), 'rb') as original, open(join(dir, 'Custom.bin'), 'rb') as packed: self.assertEqual(packed.read(), original.read())
+
+	def test_changed(self):
+		files = [(name, b'NEWCODE' * 3000 if name == '.code' else data) for name, data in self.FILES]
+		with TemporaryDirectory() as dir:
+			with open(join(dir, 'ExeFS.bin'), 'wb') as file: file.write(buildExeFS(self.FILES))
+			unpackExeFS(join(dir, 'ExeFS.bin'), join(dir, 'ExtractedExeFS'), join(dir, 'HeaderExeFS.bin'))
+			with open(join(dir, 'ExtractedExeFS', 'code.bin'), 'wb') as file: file.write(files[0][1])
+			packExeFS(join(dir, 'ExtractedExeFS'), join(dir, 'HeaderExeFS.bin'), join(dir, 'Custom.bin'))
+			with open(join(dir, 'Custom.bin'), 'rb') as file: self.assertEqual(file.read(), buildExeFS(files))
+			self.assertNotIn('Custom.bin.part', listdir(dir))
+
+	def test_invalid(self):
+		with TemporaryDirectory() as dir:
+			exefs = bytearray(buildExeFS(self.FILES))
+			exefs[0x0C:0x10] = struct.pack('<I', len(exefs)) # the size of .code exceeds the file
+			with open(join(dir, 'ExeFS.bin'), 'wb') as file: file.write(exefs)
+			with self.assertRaises(ValueError): unpackExeFS(join(dir, 'ExeFS.bin'), join(dir, 'ExtractedExeFS'), join(dir, 'HeaderExeFS.bin'))
+
+def buildCIA(contents, encrypted = ()):
+	""" Returns a CIA containing the [contents], a list of (index, data). The contents in [encrypted] are marked as encrypted. """
+	align = lambda data: bytes(data) + bytes(-len(data) % 64)
+	header, cert, ticket = bytearray(0x2020), b'C' * 0xA00, b'T' * 0x350
+	tmd = bytearray((0x10004).to_bytes(4, 'big') + bytes(0x13C) + bytes(0xC4) + bytes(0x900))
+	tmd[0x140+0x9E:0x140+0xA0] = len(contents).to_bytes(2, 'big')
+	for index, data in contents:
+		tmd += struct.pack('>IHHQ', 0x100 + index, index, 1 if index in encrypted else 0, len(data)) + bytes(0x20)
+		header[0x20 + index // 8] |= 0x80 >> index % 8
+	struct.pack_into('<IHHIIIIQ', header, 0, 0x2020, 0, 0, len(cert), len(ticket), len(tmd), 0, sum(len(data) for _, data in contents))
+	return align(header) + align(cert) + align(ticket) + align(tmd) + b''.join(data for _, data in contents)
+
+def buildNCSD(partitions):
+	""" Returns an NCSD containing the [partitions], a list of (index, data), each padded to a multiple of 0x200 bytes. """
+	header, body = bytearray(0x4000), bytearray()
+	header[0x100:0x104] = b'NCSD'
+	for index, data in partitions:
+		data = data + bytes(-len(data) % 0x200)
+		struct.pack_into('<II', header, 0x120 + index*8, (len(header) + len(body)) // 0x200, len(data) // 0x200)
+		body += data
+	return bytes(header + body)
+
+class ContainersTest(unittest.TestCase):
+
+	PARTITIONS = [(0, b'NCCH0' * 1000), (1, b'NCCH1' * 100), (2, b'NCCH2' * 10), (6, b'UPDATE' * 10)]
+
+	def split(self, name, game, ids = (0, 1, 2)):
+		""" Splits the [game] saved as [name] and returns the written files as a dict of name → data. """
+		with TemporaryDirectory() as dir:
+			with open(join(dir, name), 'wb') as file: file.write(game)
+			makedirs(join(dir, 'Game'))
+			splitGame(join(dir, name), join(dir, 'Game'), ids)
+			written = dict()
+			for f in listdir(join(dir, 'Game')):
+				with open(join(dir, 'Game', f), 'rb') as file: written[f] = file.read()
+			return written
+
+	def test_cia_contents(self):
+		with TemporaryDirectory() as dir:
+			with open(join(dir, 'Game.cia'), 'wb') as file: file.write(buildCIA(self.PARTITIONS))
+			with open(join(dir, 'Game.cia'), 'rb') as file: contents = ciaContents(file)
+			with open(join(dir, 'Game.cia'), 'rb') as file: game = file.read()
+		self.assertEqual([index for index, _, _ in contents], [0, 1, 2, 6])
+		for (index, offset, size), (_, data) in zip(contents, self.PARTITIONS): self.assertEqual(game[offset:offset+size], data)
+
+	def test_ncsd_partitions(self):
+		with TemporaryDirectory() as dir:
+			with open(join(dir, 'Game.3ds'), 'wb') as file: file.write(buildNCSD(self.PARTITIONS))
+			with open(join(dir, 'Game.3ds'), 'rb') as file: partitions = ncsdPartitions(file)
+			with open(join(dir, 'Game.3ds'), 'rb') as file: game = file.read()
+		self.assertEqual([index for index, _, _ in partitions], [0, 1, 2, 6])
+		for (index, offset, size), (_, data) in zip(partitions, self.PARTITIONS): self.assertEqual(game[offset:offset+size].rstrip(b'\0'), data)
+
+	def test_split_cia(self):
+		written = self.split('Game.cia', buildCIA(self.PARTITIONS))
+		self.assertEqual(written, {'DecryptedPartition%d.bin' % index: data for index, data in self.PARTITIONS if index in (0, 1, 2)})
+
+	def test_split_3ds(self):
+		game = buildNCSD(self.PARTITIONS)
+		written = self.split('Game.3ds', game, ids=(0, 6))
+		self.assertEqual(sorted(written), ['DecryptedPartition0.bin', 'DecryptedPartition6.bin', 'HeaderNCCH.bin'])
+		self.assertEqual(written['HeaderNCCH.bin'], game[:0x4000])
+		self.assertEqual(written['DecryptedPartition0.bin'], self.PARTITIONS[0][1] + bytes(-len(self.PARTITIONS[0][1]) % 0x200))
+
+	def test_encrypted(self):
+		with self.assertRaises(NotImplementedError): self.split('Game.cia', buildCIA(self.PARTITIONS, encrypted=(1,)))
+
+	def test_invalid(self):
+		for name, game in [('Game.cia', buildCIA(self.PARTITIONS)[:-100]), ('Game.3ds', buildNCSD(self.PARTITIONS)[:-0x200]), ('Game.3ds', bytes(0x4000))]:
+			with self.subTest(name=name, size=len(game)), self.assertRaises(ValueError): self.split(name, game)
+
+if __name__ == '__main__':
+	unittest.main()
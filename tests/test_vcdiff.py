@@ -0,0 +1,60 @@
+""" Tests the built-in VCDIFF decoder against deltas created by xdelta 3.1.1.
+	The fixtures in fixtures/vcdiff were created with:
+		xdelta3 -e -f -s source.bin target.bin default.xdelta
+		xdelta3 -e -f -S lzma -s source.bin target.bin lzma.xdelta
+		xdelta3 -e -f -S none -s source.bin target.bin none.xdelta
+		xdelta3 -e -f -W 16384 -s large_source.bin large_target.bin windows.xdelta
+		xdelta3 -e -f -S none -W 16384 -s large_source.bin large_target.bin windows_none.xdelta
+		xdelta3 -e -f -s empty.bin target.bin empty_source.xdelta
+"""
+
+import sys
+import unittest
+from os.path import join, split, abspath
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, split(split(abspath(__file__))[0])[0])
+from GamePatcher import vcdiffSupported, decodeVCDiff
+
+FIXTURES = join(split(abspath(__file__))[0], 'fixtures', 'vcdiff')
+
+class DecodeVCDiffTest(unittest.TestCase):
+	
+	def decode(self, delta, source, target):
+		""" Decodes [delta] with [source] and checks that the result equals [target]. """
+		with open(join(FIXTURES, delta), 'rb') as file: self.assertTrue(vcdiffSupported(file.read(6)))
+		with TemporaryDirectory() as dir, open(join(FIXTURES, delta), 'rb') as patch:
+			decodeVCDiff(patch, join(FIXTURES, source), join(dir, 'target.bin'))
+			with open(join(dir, 'target.bin'), 'rb') as file: result = file.read()
+		with open(join(FIXTURES, target), 'rb') as file: self.assertEqual(result, file.read())
+	
+	def test_default(self):
+		self.decode('default.xdelta', 'source.bin', 'target.bin')
+	
+	def test_lzma(self):
+		self.decode('lzma.xdelta', 'source.bin', 'target.bin')
+	
+	def test_uncompressed(self):
+		self.decode('none.xdelta', 'source.bin', 'target.bin')
+	
+	def test_windows(self):
+		self.decode('windows.xdelta', 'large_source.bin', 'large_target.bin')
+	
+	def test_windows_uncompressed(self):
+		self.decode('windows_none.xdelta', 'large_source.bin', 'large_target.bin')
+	
+	def test_empty_source(self):
+		self.decode('empty_source.xdelta', 'empty.bin', 'target.bin')
+	
+	def test_checksum_mismatch(self):
+		with open(join(FIXTURES, 'none.xdelta'), 'rb') as file: delta = bytearray(file.read())
+		with open(join(FIXTURES, 'source.bin'), 'rb') as file: source = bytearray(file.read())
+		source[100] ^= 0xFF # the delta copies from here
+		with TemporaryDirectory() as dir:
+			with open(join(dir, 'source.bin'), 'wb') as file: file.write(source)
+			with open(join(dir, 'none.xdelta'), 'wb') as file: file.write(delta)
+			with open(join(dir, 'none.xdelta'), 'rb') as patch, self.assertRaises(ValueError):
+				decodeVCDiff(patch, join(dir, 'source.bin'), join(dir, 'target.bin'))
+
+if __name__ == '__main__':
+	unittest.main()